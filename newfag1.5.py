@@ -1,4 +1,6 @@
-import urllib, sys, time, pickle
+import urllib, sys, time, pickle, heapq, bisect, random, math, zlib, os, gzip, copy
+import httplib, urlparse, socket, threading, Queue, csv, json, hashlib, collections
+import struct, mmap, tempfile
 
 ## The following code changes the User-Agent so search results won't prompt a
 ## 403 error. See http://wolfprojects.altervista.org/changeua.php
@@ -40,6 +42,50 @@ class NewFagMeter:
          M 
             - A matrix of the training data. M[i][j] will return the i'th
             user's j'th favourite series. M[i][0] is the i'th users show count
+            
+         showCounts
+            - A ShowCountStats of every M[i][0], kept sorted so the mean,
+            median and percentiles don't need a full pass
+            
+         coListing
+            - A CoListingMatrix of how often each pair of series is listed
+            together. None until buildCoListing is called
+            
+         userIndex
+            - A MinHashIndex over the users' lists of series. None until
+            buildUserIndex is called
+            
+         seriesSketches / weightMethod
+            - the QuantileSketch of show counts per series and the
+            statistic robustLearn took from them. seriesSketches is None and
+            weightMethod "mean" after naiveLearn
+            
+         seriesIndex
+            - A dict of show to its position in seriesList, built when first
+            needed and dropped when shows are removed
+            
+         modelVersion
+            - bumped whenever the weights or data change (learning, addUser,
+            removeUser), so anything cached from the model can tell it is
+            stale
+            
+         scoreCache
+            - a ScoreCache of cachedScore results
+            
+         weightIntervals / popularityIntervals
+            - (low, high) bootstrap confidence intervals matching
+            seriesWeights and popularityList. None until bootstrap is called
+            
+         hashedModel
+            - a HashedFeatureModel of M, None until hashedLearn is called
+            
+         alsModel
+            - an ALSModel factorization of M, None until alsLearn is called
+            
+         aliasClusters / unclusteredM
+            - a snapshot of the AliasClusters applied by applyAliasClusters,
+            and M as it was parsed, row for row. Both None when no clusters
+            are applied
               
     Initialization:
          The first arg is a txtfile with the format
@@ -80,11 +126,89 @@ class NewFagMeter:
          binaryISE
             - It takes a binary classifier and outputs the in-sample error.
             
+         hashedLearn / hashedClassifyScore
+            - a model of a fixed number of hashed buckets instead of one
+            weight per series, so memory doesn't grow with the catalog and
+            titles never seen still get a score
+            
+         alsLearn / alsClassifyScore
+            - factorizes the anon x series listings into series embeddings
+            (implicit feedback ALS) and predicts the show count of a list
+            from the embedding it folds into
+            
+         leaveOneOut
+            - exact leave-one-out predictions and errors of the naive
+            learner for every anon, from one pass over the data instead of
+            a retrain per anon
+            
+         scoreReport
+            - every scoring metric for a list in one pass: predicted show
+            count, binary class, average popularity, per show weights, hits,
+            misses and coverage
+            
+         cachedScore
+            - score, binary class and average popularity of a list, served
+            from an LRU cache keyed by the set of standardized shows
+            
          getMedianScore
             - returns the median of the number of shows people have watched
             
          getMeanScore
             - returns the mean of the number of shows people have watched
+            
+         getPercentile / getHistogram
+            - percentiles and histograms of show counts, answered from the
+            showCounts order statistics without re-sorting
+            
+         addUser / removeUser
+            - add or remove a submission, updating the catalog, popularity,
+            learned weights and show count statistics incrementally
+            
+         copy
+            - returns an independent copy of the model, which can be changed
+            without disturbing anyone still using the original
+            
+         writeImage
+            - writes the trained model to a ModelImage file that any number
+            of ScoringPool worker processes can mmap and share
+            
+         buildCoListing
+            - builds the sparse series x series co-listing matrix
+            
+         alsoListed
+            - anons who listed this show also listed... Returns the k most
+            associated shows by PMI, cosine or jaccard similarity
+            
+         knnClassifyScore
+            - predicts the show count from the k anons whose lists are most
+            similar (jaccard) to the input, found through a MinHash index
+            
+         gridClassifyScore
+            - takes a 3x3 chart image, recognizes each tile offline against
+            a CoverArtIndex and returns linearClassifyScore of the result
+            
+         rankedPopularity / rankedPowerLevel
+            - iterate over a page of ranks (e.g. 500 to 550) without sorting
+            the whole catalog. Power level can be filtered by a minimum
+            popularity or a maximum bootstrap interval width so shows listed
+            once don't top the scale
+            
+         bootstrap
+            - bootstrap confidence intervals for every show's weight and
+            popularity
+            
+         robustLearn
+            - like naiveLearn, but the weight is the median, trimmed mean or
+            winsorized mean of the show counts, read off a bounded memory
+            QuantileSketch per series so trolls can't drag it around
+            
+         topPopular / topPowerLevel
+            - return the top k shows, found with a heap unless the full
+            order has already been cached
+            
+         proposeMerges / applyAliasClusters
+            - suggest series names that are one work, and count the series
+            of each AliasClusters cluster as one (reversibly)
     
     Functions:
         
@@ -97,13 +221,91 @@ class NewFagMeter:
             the goole/wikipedia method
         
         loadDB
-            - Takes in the name of a pickled dictionary and returns the dict
+            - Takes in the name of a pickled dictionary and returns the dict,
+            or an AliasStore if the file is one
+            
+         saveDB
+            - Pickles a name conversion dictionary to file, or rewrites an
+            AliasStore in its own format
+            
+         AliasStore
+            - a name conversion dictionary in a compact binary file that is
+            mmap'd and searched in place instead of unpickled. Converted
+            from and to the pickle with pickleToAliasStore and
+            aliasStoreToPickle
+            
+         TitleIndex
+            - an offline resolver for parseTitle, built from a local dump of
+            Wikipedia titles and redirects
+            
+         ResolverTransport
+            - a pool of keep-alive HTTP connections with timeouts, gzip and
+            retries with backoff, for talking to the search server
+            
+         SearchResolver
+            - a resolver for parseTitle that runs the google/wikipedia search
+            over a ResolverTransport
+            
+         ModelReloader
+            - keeps a model in sync with its data and names files, swapping
+            in a rebuilt (or incrementally updated) model atomically
+            
+         ModelImage / ScoringPool
+            - a read only model in one mmap'd file, and a pool of worker
+            processes scoring batches of lists against it
+            
+         ALSModel
+            - implicit feedback matrix factorization of the anon x series
+            listings with blocked numpy solves
+            
+         HashedFeatureModel
+            - fixed size hashed series weights with collision reporting
+            
+         AliasClusters
+            - a union-find of series names that are one work, and
+            proposeAliasMerges to suggest what to merge from title
+            similarity, redirects and co-listing
+            
+         IngestDaemon
+            - follows a submission file, directory or local socket and adds
+            new submissions to a live model and the data file in batches,
+            checkpointing how far it has read
+            
+         ShardServer / ShardedModel
+            - the catalog split by hash of series name over several shard
+            servers, and a coordinator that scatters queries to them and
+            merges the answers
+            
+         BulkImporter
+            - streams several survey exports (text, CSV, JSON lines) into
+            one list of data points, skipping any record already imported
+            and any a UserValidator rejects
+            
+         BatchResolver
+            - resolves many uncached titles at once with a few concurrent
+            lookups under a TokenBucket rate limit, saving the names
+            database once per batch
+            
+         parseLines
+            - parseData for any iterable of lines, e.g. the new end of a
+            file that was appended to
+            
+         printScale
+            - prints a ranking of (rank, show, value) in a single write
+            
+         selectKth
+            - k'th smallest of a list in expected linear time
+            
+         recognizeGrid
+            - splits a 3x3 chart into tiles (gridTiles), hashes each one
+            (dHash) and looks it up in a CoverArtIndex
             
     TODO:
     
          Long Term
             - Modify classify method to work on 3x3's. It should use google 
-              reverse image search to obtain the series name
+              reverse image search to obtain the series name (an offline
+              version using a local CoverArtIndex is in gridClassifyScore)
               
             - Automate the collection of training data
             
@@ -124,9 +326,9 @@ class NewFagMeter:
             - Gain feedback on improvements to be made
          
     '''
-    def __init__(self, txtFile, dbFile):
+    def __init__(self, txtFile, dbFile, resolver = None):
         '''
-        NewFagMeter(self, txtFile, dbFile)
+        NewFagMeter(self, txtFile, dbFile, resolver = None)
         The first arg is a txtfile with the format
         
               # of shows seen for user 1
@@ -145,6 +347,9 @@ class NewFagMeter:
         
         The second arg is the name of a pickle file, which will be converted
         to the instances nameConversion field        
+        
+        resolver is an optional callable used instead of the google search
+        for names not in the pickle, e.g. a TitleIndex for offline lookups
         '''
         self.seriesList = []
         self.seriesWeights = []
@@ -152,9 +357,35 @@ class NewFagMeter:
         self.binaryThreshold = 50
         self.seriesDBFile = dbFile
         self.seriesDB = loadDB(dbFile)
-        self.M = parseData(txtFile, dbFile, loadDB(dbFile))
-        self.popularityList = []       
+        self.resolver = resolver
+        self.M = parseData(txtFile, dbFile, self.seriesDB, resolver)
+        self.popularityList = []
+        self.rankCache = {}
+        self.modelVersion = 0
+        self.scoreCache = ScoreCache()
+        self.seriesIndex = None
+        self.aliasClusters = None
+        self.unclusteredM = None
+        self.hashedModel = None
+        self.alsModel = None
+        self._buildCatalog()
         
+        self.showCounts = ShowCountStats([user[0] for user in self.M])
+        self.coListing = None
+        self.userIndex = None
+        self.weightIntervals = None
+        self.popularityIntervals = None
+        self.seriesSketches = None
+        self.weightMethod = "mean"
+            
+    def _buildCatalog(self):
+        '''
+        _buildCatalog(self)
+        - fills seriesList and popularityList from M
+        '''
+        self.seriesList = []
+        self.popularityList = []
+        self.seriesIndex = None
         for user in self.M:
             for show in user[1:]:
                 if show not in self.seriesList:
@@ -166,15 +397,19 @@ class NewFagMeter:
                 if show in user[:]:
                     popularity += 1
             self.popularityList.append(popularity)
-            
+    
     def parseTitle(self, show):
         '''
         parseTitle(self, show)
         - returns the standardized name for show. If not already in the
         nameConversion dictionary, it adds the mapping, and re-writes the
-        new dictionary to file
+        new dictionary to file. With alias clusters applied the name is that
+        of the show's cluster
         '''
-        return parseTitle(show, self.seriesDBFile, self.seriesDB)
+        show = parseTitle(show, self.seriesDBFile, self.seriesDB, self.resolver)
+        if self.aliasClusters is not None:
+            show = self.aliasClusters.canonical(show)
+        return show
     
     def addNameMapping(self, show, name):
         '''
@@ -183,9 +418,7 @@ class NewFagMeter:
         dictionary
         '''
         self.seriesDB[show] = name
-        output = open(self.seriesDBFile, 'wb')
-        pickle.dump(self.seriesDB, output)
-        output.close()
+        saveDB(self.seriesDB, self.seriesDBFile)
  
     def findMappings(self, name):
         '''
@@ -206,6 +439,11 @@ class NewFagMeter:
         the average of show counts for the set of users where that series
         is present.        
         '''
+        self.rankCache = {}
+        self.modelVersion += 1
+        self.seriesSketches = None
+        self.weightMethod = "mean"
+        self.seriesWeights = []
         for show in self.seriesList:
             totalWeight = 0
             viewCount = 0.0
@@ -215,6 +453,32 @@ class NewFagMeter:
                     viewCount += 1
             self.seriesWeights.append(totalWeight / viewCount)
     
+    def robustLearn(self, method = "median", trim = 0.1, sketchSize = 200,
+                    chunkSize = 10000, seed = 0):
+        '''
+        robustLearn(self, method = "median", trim = 0.1, sketchSize = 200,
+                    chunkSize = 10000, seed = 0)
+        - A learning algorithm that resists outliers. The weight of the
+        series is the median ("median"), the mean of the middle 1 - 2 * trim
+        of show counts ("trimmed"), or the mean after clamping the lowest
+        and highest trim to the quantiles there ("winsorized"), for the set
+        of users where that series is present. The show counts go through
+        a QuantileSketch per series (see buildSeriesSketches) so memory is
+        bounded however many users list a series. The sketches are seeded
+        with seed, so the same data always gives the same weights
+        '''
+        if method not in ("median", "trimmed", "winsorized"):
+            raise ValueError("unknown method: " + str(method))
+        self.rankCache = {}
+        self.modelVersion += 1
+        self.weightMethod = method
+        self.trim = trim
+        self.sketchSize = sketchSize
+        self.sketchSeed = seed
+        self.seriesSketches = buildSeriesSketches(self.M, sketchSize, chunkSize, seed)
+        self.seriesWeights = [self.seriesSketches[show].statistic(method, trim)
+                              for show in self.seriesList]
+    
     def getWeight(self, show, standardize = True):
         '''
         getWeight(self, show, standardize = True)
@@ -222,7 +486,7 @@ class NewFagMeter:
         will be standardized in this function
         '''
         if standardize:
-            show = parseTitle(show, self.seriesDBFile, self.seriesDB)
+            show = self.parseTitle(show)
         if show in self.seriesList:
             return self.seriesWeights[self.seriesList.index(show)]
         else:
@@ -232,22 +496,92 @@ class NewFagMeter:
         '''
         linearClassifyScore(self, inputlist, standardize = True)
         - given an input list of any length, will attempt to predict
-        the total number of shows watched
+        the total number of shows watched. Returns None if none of the shows
+        are known (see hashedClassifyScore for a model that knows them all)
         '''
         score = 0
         total = 0
         for show in inputlist:
             if standardize:
-                show = parseTitle(show, self.seriesDBFile, self.seriesDB)
-            if show in self.seriesList:
-                score += self.seriesWeights[self.seriesList.index(show)]
+                show = self.parseTitle(show)
+            j = self._indexOf(show)
+            if j != -1:
+                score += self.seriesWeights[j]
                 total += 1.0
+        if total == 0:
+            return None
         return score / total
     
+    def cachedScore(self, inputlist, standardize = True):
+        '''
+        cachedScore(self, inputlist, standardize = True)
+        - returns a ScoreEntry with the linearClassifyScore,
+        binaryClassifyScore and linearClassifyPop of the input list, taken
+        from scoreCache when the same set of shows (in any order) has been
+        scored before by this version of the model. A show listed twice
+        counts once. score and popularity are None if no show is known,
+        and binaryClass is -1 then, as binaryClassifyScore gives
+        '''
+        if standardize:
+            inputlist = [self.parseTitle(show) for show in inputlist]
+        key = frozenset(inputlist)
+        version = (self.modelVersion, self.binaryThreshold)
+        entry = self.scoreCache.get(key, version)
+        if entry is not None:
+            return entry
+        report = self.scoreReport(list(key), False)
+        entry = ScoreEntry(report.score, report.binaryClass, report.popularity)
+        self.scoreCache.put(key, version, entry)
+        return entry
+    
+    def scoreReport(self, inputlist, standardize = True):
+        '''
+        scoreReport(self, inputlist, standardize = True)
+        - returns a ScoreReport of the input list. Each title is
+        standardized once and looked up once, and score, binaryClass and
+        popularity equal what linearClassifyScore, binaryClassifyScore and
+        linearClassifyPop give (if no show is known, score and popularity
+        are None and binaryClass is -1)
+        '''
+        score = 0.0
+        pop = 0.0
+        weights = []
+        hitList = []
+        missList = []
+        for title in inputlist:
+            show = title
+            if standardize:
+                show = self.parseTitle(title)
+            j = self._indexOf(show)
+            if j == -1:
+                missList.append(title)
+                continue
+            score += self.seriesWeights[j]
+            pop += self.popularityList[j]
+            weights.append((show, self.seriesWeights[j]))
+            hitList.append(show)
+        report = ScoreReport(weights, hitList, missList)
+        if hitList:
+            report.score = score / len(hitList)
+            report.popularity = pop / len(hitList)
+            if report.score >= self.binaryThreshold:
+                report.binaryClass = 1
+        return report
+    
+    def _indexOf(self, show):
+        '''
+        _indexOf(self, show)
+        - returns the position of show in seriesList, or -1
+        '''
+        if self.seriesIndex is None:
+            self.seriesIndex = dict((name, j) for (j, name) in enumerate(self.seriesList))
+        return self.seriesIndex.get(show, -1)
+    
     def binaryClassifyScore(self, inputlist, standardize = True):
         '''
         binaryClassifyScore(self, inputlist, standardize = True)
-        - returns 1 if linearClassifyScore() is >= binaryThreashold
+        - returns 1 if linearClassifyScore() is >= binaryThreashold, -1
+        otherwise (also when no show is known)
         '''
         if self.linearClassifyScore(inputlist, standardize) >= self.binaryThreshold:
             return 1
@@ -272,32 +606,134 @@ class NewFagMeter:
             total += 1
         return error * 100 / total    
     
+    def hashedLearn(self, buckets = 65536):
+        '''
+        hashedLearn(self, buckets = 65536)
+        - the naive learner over hashed features: every series is put in
+        one of buckets buckets by a hash of its name, and the weight of a
+        bucket is the average show count of the anons listing a series in
+        it. Sets and returns hashedModel
+        '''
+        self.hashedModel = HashedFeatureModel(buckets)
+        for user in self.M:
+            self.hashedModel.add(user)
+        return self.hashedModel
+    
+    def hashedClassifyScore(self, inputlist, standardize = True):
+        '''
+        hashedClassifyScore(self, inputlist, standardize = True)
+        - like linearClassifyScore, with the weights of hashedModel. A title
+        that isn't in the catalog still gets the weight of its bucket; one
+        that can't be standardized at all is hashed by its normalized
+        title. Returns None only if every bucket hit is empty
+        '''
+        if self.hashedModel is None:
+            self.hashedLearn()
+        shows = []
+        for title in inputlist:
+            show = title
+            if standardize:
+                show = self.parseTitle(title)
+                if show == "Unknown":
+                    show = normalizeTitle(title)
+            shows.append(show)
+        return self.hashedModel.score(shows)
+    
+    def alsLearn(self, factors = 32, regularization = 0.1, alpha = 40.0,
+                 iterations = 10, blockEntries = 65536, seed = 0):
+        '''
+        alsLearn(self, factors = 32, regularization = 0.1, alpha = 40.0,
+                 iterations = 10, blockEntries = 65536, seed = 0)
+        - fits an ALSModel to M with these settings (see ALSModel). Sets and
+        returns alsModel. Later addUser and removeUser calls fold anons in
+        and out of it without refitting
+        '''
+        self.alsModel = ALSModel(factors, regularization, alpha, iterations,
+                                 blockEntries, seed)
+        self.alsModel.fit(self.M)
+        return self.alsModel
+    
+    def alsClassifyScore(self, inputlist, standardize = True):
+        '''
+        alsClassifyScore(self, inputlist, standardize = True)
+        - predicts the total number of shows watched from the embedding the
+        input list folds into in alsModel (fitted first if need be). Returns
+        None if none of the shows are known
+        '''
+        if self.alsModel is None:
+            self.alsLearn()
+        if standardize:
+            inputlist = [self.parseTitle(show) for show in inputlist]
+        return self.alsModel.predictCount(inputlist)
+    
+    def leaveOneOut(self):
+        '''
+        leaveOneOut(self)
+        -returns a LeaveOneOutReport of what naiveLearn and
+        linearClassifyScore would predict for each anon had they not been
+        in M. The per-series sums and counts of show counts are made once,
+        and each anon's own show count is taken back out of the series they
+        list, so it's exact and linear in the size of M. Series only that
+        anon listed are unknown without them and skipped, as
+        linearClassifyScore skips unknown shows; an anon whose every series
+        is like that gets the mean show count of everyone else
+        '''
+        totals = {}
+        counts = {}
+        for user in self.M:
+            for show in set(user[1:]):
+                totals[show] = totals.get(show, 0) + user[0]
+                counts[show] = counts.get(show, 0) + 1
+        allTotal = float(sum(user[0] for user in self.M))
+        predictions = []
+        unscored = 0
+        for user in self.M:
+            score = 0.0
+            total = 0
+            for show in user[1:]:
+                others = counts[show] - 1
+                if others > 0:
+                    score += (totals[show] - user[0]) / float(others)
+                    total += 1
+            if total:
+                predictions.append(score / total)
+            else:
+                unscored += 1
+                if len(self.M) > 1:
+                    predictions.append((allTotal - user[0]) / (len(self.M) - 1))
+                else:
+                    predictions.append(None)
+        return LeaveOneOutReport([user[0] for user in self.M], predictions,
+                                 self.binaryThreshold, unscored)
+    
     def getMedianScore(self):
         '''
         getMedianScore(self)
         -returns median of number ofshows watched
         '''
-        userScores = []
-        for user in self.M:
-            userScores.append(user[0])
-        userScores.sort()
-        
-        if len(userScores) % 2 == 0:
-            return userScores[len(userScores)/ 2]
-        else:
-            return userScores[(len(userScores) + 1)/ 2]
+        return self.showCounts.median()
             
     def getMeanScore(self):
         '''
         getMeanScore(self)
         -returns  mean of numbe of shows watched
         '''
-        totalUserScore = 0.0
-        numberOfUsers = 0.0
-        for user in self.M:
-            totalUserScore += user[0]
-            numberOfUsers += 1
-        return totalUserScore / numberOfUsers
+        return self.showCounts.mean()
+    
+    def getPercentile(self, p):
+        '''
+        getPercentile(self, p)
+        -returns the p'th percentile (0 to 100) of number of shows watched
+        '''
+        return self.showCounts.percentile(p)
+    
+    def getHistogram(self, edges):
+        '''
+        getHistogram(self, edges)
+        -returns how many anons fall in each [edges[i], edges[i + 1]) bin
+        of number of shows watched
+        '''
+        return self.showCounts.histogram(edges)
     
     def getPopularity(self, show, standardize = True):
         '''
@@ -306,7 +742,7 @@ class NewFagMeter:
         in this function
         '''
         if standardize:
-            show = parseTitle(show, self.seriesDBFile, self.seriesDB)
+            show = self.parseTitle(show)
         if show in self.seriesList:
             return self.popularityList[self.seriesList.index(show)]
         else:
@@ -315,17 +751,21 @@ class NewFagMeter:
     def linearClassifyPop(self, inputlist, standardize = True):
         '''
         linearClassifyPop(self, inputlist, standardize = True)
-        -returns average popularity of input shows
+        -returns average popularity of input shows, None if none of them
+        are known
         '''
         pop = 0
         total = 0
         for show in inputlist:
             if standardize:
-                show = parseTitle(show, self.seriesDBFile, self.seriesDB)
-            if show in self.seriesList:
-                pop += self.popularityList[self.seriesList.index(show)]
+                show = self.parseTitle(show)
+            j = self._indexOf(show)
+            if j != -1:
+                pop += self.popularityList[j]
                 total += 1.0
-        return pop / total    
+        if total == 0:
+            return None
+        return pop / total
     
     def ithPopular(self, i):
         '''
@@ -352,20 +792,29 @@ class NewFagMeter:
         pL.sort()
         return result, pL[i]
     
-    def printPopularityScale(self):
+    def printPopularityScale(self, start = 1, stop = None):
         '''
-        printPopularityScale(self)
+        printPopularityScale(self, start = 1, stop = None)
         -prints shows in order of popularity, along with number of entries
-        that include the given show
+        that include the given show. start and stop limit the output to
+        that range of ranks (inclusive)
         '''
-        pL = self.popularityList[:]
-        sL = self.seriesList[:]
-        lst = [x for (y,x) in sorted(zip(pL, sL))]
-        pL.sort()
-        lst.reverse()
-        for i, show in enumerate(lst):
-            print "Rank:" + str(i + 1), "| Title: " + show, 
-            print "- " +str(pL[-i - 1]) 
+        printScale(self.rankedPopularity(start, stop))
+    
+    def rankedPopularity(self, start = 1, stop = None):
+        '''
+        rankedPopularity(self, start = 1, stop = None)
+        -yields (rank, show, popularity) for ranks start to stop inclusive,
+        most popular first
+        '''
+        return self._rankedShows("popularity", start, stop, 0)
+    
+    def topPopular(self, k):
+        '''
+        topPopular(self, k)
+        -returns a list of the k most popular (rank, show, popularity)
+        '''
+        return list(self.rankedPopularity(1, k))
     
     def ithLargest(self, i):
         '''
@@ -392,20 +841,118 @@ class NewFagMeter:
         sW.sort()
         return result, sW[i]
     
-    def printPowerLevelScale(self):
+    def printPowerLevelScale(self, start = 1, stop = None, minPopularity = 0,
+                             maxIntervalWidth = None):
         '''
-        printPowerLevelScale(self)
+        printPowerLevelScale(self, start = 1, stop = None, minPopularity = 0,
+                             maxIntervalWidth = None)
         -print shows in order of powerlevel, along with average power level
-        of anons who included that show
+        of anons who included that show. start and stop limit the output to
+        that range of ranks, and shows listed by fewer than minPopularity
+        anons or whose bootstrap interval is wider than maxIntervalWidth are
+        left out
         '''
-        sW = self.seriesWeights[:]
-        sL = self.seriesList[:]
-        lst = [x for (y,x) in sorted(zip(sW, sL))]
-        sW.sort()
-        lst.reverse()
-        for i, show in enumerate(lst):
-            print "Rank:" + str(i + 1), "| Title: " + show, 
-            print "- " + str(sW[-i - 1])  
+        printScale(self.rankedPowerLevel(start, stop, minPopularity,
+                                         maxIntervalWidth))
+    
+    def rankedPowerLevel(self, start = 1, stop = None, minPopularity = 0,
+                         maxIntervalWidth = None):
+        '''
+        rankedPowerLevel(self, start = 1, stop = None, minPopularity = 0,
+                         maxIntervalWidth = None)
+        -yields (rank, show, power level) for ranks start to stop inclusive,
+        highest power level first. Only shows with a popularity of at least
+        minPopularity are ranked, and if maxIntervalWidth is given only those
+        whose weight interval from bootstrap() is at most that wide
+        '''
+        return self._rankedShows("powerLevel", start, stop, minPopularity,
+                                 maxIntervalWidth)
+    
+    def topPowerLevel(self, k, minPopularity = 0, maxIntervalWidth = None):
+        '''
+        topPowerLevel(self, k, minPopularity = 0, maxIntervalWidth = None)
+        -returns a list of the k most oldfag (rank, show, power level)
+        '''
+        return list(self.rankedPowerLevel(1, k, minPopularity, maxIntervalWidth))
+    
+    def _rankedShows(self, scale, start, stop, minPopularity,
+                     maxIntervalWidth = None):
+        '''
+        _rankedShows(self, scale, start, stop, minPopularity,
+                     maxIntervalWidth = None)
+        -yields (rank, show, value) for ranks start to stop of the given
+        scale ("popularity" or "powerLevel"). A full ranking is cached in
+        rankCache the first time one is needed; until then only the top
+        stop shows are pulled out with a heap
+        '''
+        if scale == "popularity":
+            values = self.popularityList
+        else:
+            values = self.seriesWeights
+        if maxIntervalWidth is not None and self.weightIntervals is None:
+            raise ValueError("maxIntervalWidth needs bootstrap() to be run first")
+        order = self.rankCache.get((scale, minPopularity, maxIntervalWidth))
+        if order is None:
+            candidates = [j for j in xrange(len(values))
+                          if self.popularityList[j] >= minPopularity]
+            if maxIntervalWidth is not None:
+                intervals = self.weightIntervals
+                candidates = [j for j in candidates
+                              if intervals[j][1] - intervals[j][0] <= maxIntervalWidth]
+            rankKey = lambda j: (values[j], self.seriesList[j])
+            if stop is None or stop >= len(candidates):
+                order = sorted(candidates, key = rankKey, reverse = True)
+                self.rankCache[(scale, minPopularity, maxIntervalWidth)] = order
+            else:
+                order = heapq.nlargest(stop, candidates, key = rankKey)
+        if stop is None or stop > len(order):
+            stop = len(order)
+        for rank in xrange(max(start, 1), stop + 1):
+            j = order[rank - 1]
+            yield rank, self.seriesList[j], values[j]
+    
+    def bootstrap(self, replicates = 1000, confidence = 0.95, processes = 1,
+                  batchSize = None, seed = 0):
+        '''
+        bootstrap(self, replicates = 1000, confidence = 0.95, processes = 1,
+                  batchSize = None, seed = 0)
+        -sets weightIntervals and popularityIntervals to the bootstrap
+        confidence intervals of each show's weight and popularity, and
+        returns them. Needs naiveLearn to have been run. See
+        bootstrapSeries for how the replicates are drawn
+        '''
+        import numpy
+        index = dict((show, j) for (j, show) in enumerate(self.seriesList))
+        users = []
+        series = []
+        for u, user in enumerate(self.M):
+            for show in set(user[1:]):
+                users.append(u)
+                series.append(index[show])
+        counts = numpy.array([user[0] for user in self.M], dtype = numpy.float64)
+        weights, popularity = bootstrapSeries(counts, users, series,
+                                              len(self.seriesList), replicates,
+                                              processes, batchSize, seed)
+        tail = (100 - confidence * 100) / 2.0
+        low, high = numpy.percentile(weights, [tail, 100 - tail], axis = 0)
+        self.weightIntervals = zip(low.tolist(), high.tolist())
+        low, high = numpy.percentile(popularity, [tail, 100 - tail], axis = 0)
+        self.popularityIntervals = zip(low.tolist(), high.tolist())
+        self.rankCache = {}
+        self.modelVersion += 1
+        return self.weightIntervals, self.popularityIntervals
+    
+    def getWeightInterval(self, show, standardize = True):
+        '''
+        getWeightInterval(self, show, standardize = True)
+        -returns the (low, high) bootstrap interval of the show's weight
+        '''
+        if standardize:
+            show = self.parseTitle(show)
+        if show in self.seriesList:
+            return self.weightIntervals[self.seriesList.index(show)]
+        else:
+            return "Show not in database"
     
     def userBaseSize(self):
         '''
@@ -420,133 +967,4510 @@ class NewFagMeter:
         -returns the number of shows in the database
         '''
         return len(self.seriesList)
+    
+    def addUser(self, user):
+        '''
+        addUser(self, user)
+        -adds a parsed submission [show count, show 1, ...] to M. New shows
+        are added to the catalog, and if naiveLearn has been run the weights
+        of the listed shows are updated in place. With alias clusters applied
+        the shows are counted under their clusters. "Unknown" titles are
+        left out
+        '''
+        if "Unknown" in user[1:]:
+            user = [user[0]] + [show for show in user[1:] if show != "Unknown"]
+        if self.aliasClusters is not None:
+            self.unclusteredM.append(user)
+            user = [user[0]] + [self.aliasClusters.canonical(show) for show in user[1:]]
+        self.M.append(user)
+        self.showCounts.add(user[0])
+        if self.hashedModel is not None:
+            self.hashedModel.add(user)
+        if self.alsModel is not None:
+            self.alsModel.addUser(user)
+        if self.coListing is not None:
+            self.coListing.add(user)
+        if self.userIndex is not None:
+            self.userIndex.insert(user[1:], user[0])
+        self._dataChanged()
+        for show in set(user[1:]):
+            j = self._indexOf(show)
+            if j != -1:
+                self.popularityList[j] += 1
+                if self.seriesWeights:
+                    pop = self.popularityList[j]
+                    self.seriesWeights[j] += (user[0] - self.seriesWeights[j]) / float(pop)
+            else:
+                j = len(self.seriesList)
+                self.seriesList.append(show)
+                self.seriesIndex[show] = j
+                self.popularityList.append(1)
+                if self.seriesWeights:
+                    self.seriesWeights.append(float(user[0]))
+            if self.seriesSketches is not None:
+                sketch = self.seriesSketches.get(show)
+                if sketch is None:
+                    sketch = QuantileSketch(self.sketchSize, self.sketchSeed)
+                    self.seriesSketches[show] = sketch
+                sketch.add(user[0])
+                self.seriesWeights[j] = sketch.statistic(self.weightMethod, self.trim)
+    
+    def _dataChanged(self):
+        '''
+        _dataChanged(self)
+        - called by everything that changes M (addUser, removeUser,
+        applyAliasClusters): drops the cached rankings and bootstrap
+        intervals and bumps modelVersion, so scoreCache can't serve a score
+        from before the change
+        '''
+        self.rankCache = {}
+        self.weightIntervals = None
+        self.popularityIntervals = None
+        self.modelVersion += 1
+    
+    def removeUser(self, user):
+        '''
+        removeUser(self, user)
+        -removes a submission from M, undoing what addUser does. Shows that
+        no one lists anymore are dropped from the catalog. With alias
+        clusters applied, user is the submission as it was added
+        '''
+        if "Unknown" in user[1:]:
+            user = [user[0]] + [show for show in user[1:] if show != "Unknown"]
+        if self.aliasClusters is not None:
+            # M is unclusteredM mapped row for row when it was added
+            i = self.unclusteredM.index(user)
+            del self.unclusteredM[i]
+            user = self.M.pop(i)
+        else:
+            self.M.remove(user)
+        self.showCounts.remove(user[0])
+        if self.hashedModel is not None:
+            self.hashedModel.remove(user)
+        if self.alsModel is not None:
+            self.alsModel.removeUser(user)
+        if self.coListing is not None:
+            self.coListing.remove(user)
+        if self.userIndex is not None:
+            self.userIndex.remove(user[1:], user[0])
+        self._dataChanged()
+        for show in set(user[1:]):
+            j = self.seriesList.index(show)
+            pop = self.popularityList[j] - 1
+            if pop == 0:
+                del self.seriesList[j]
+                self.seriesIndex = None
+                del self.popularityList[j]
+                if self.seriesWeights:
+                    del self.seriesWeights[j]
+                if self.seriesSketches is not None:
+                    del self.seriesSketches[show]
+                continue
+            self.popularityList[j] = pop
+            if self.seriesSketches is not None:
+                # sketches can't forget a value, so rebuild this one
+                sketch = QuantileSketch(self.sketchSize, self.sketchSeed)
+                for other in self.M:
+                    if show in other[1:]:
+                        sketch.add(other[0])
+                self.seriesSketches[show] = sketch
+                self.seriesWeights[j] = sketch.statistic(self.weightMethod, self.trim)
+            elif self.seriesWeights:
+                self.seriesWeights[j] += (self.seriesWeights[j] - user[0]) / float(pop)
+    
+    def copy(self):
+        '''
+        copy(self)
+        -returns a copy of the model whose data can be changed (addUser,
+        removeUser, new name mappings) without touching this one. The
+        resolver is shared, and the co-listing and user indexes are copied
+        only if they have been built
+        '''
+        clone = copy.copy(self)
+        clone.seriesDB = self.seriesDB.copy()
+        clone.M = list(self.M)
+        clone.seriesList = list(self.seriesList)
+        clone.seriesIndex = None
+        clone.seriesWeights = list(self.seriesWeights)
+        clone.popularityList = list(self.popularityList)
+        clone.rankCache = {}
+        clone.scoreCache = ScoreCache(self.scoreCache.maxSize)
+        clone.showCounts = ShowCountStats(self.showCounts.counts)
+        clone.seriesSketches = copy.deepcopy(self.seriesSketches)
+        clone.coListing = copy.deepcopy(self.coListing)
+        clone.userIndex = copy.deepcopy(self.userIndex)
+        clone.aliasClusters = copy.deepcopy(self.aliasClusters)
+        clone.hashedModel = copy.deepcopy(self.hashedModel)
+        clone.alsModel = copy.deepcopy(self.alsModel)
+        if self.unclusteredM is not None:
+            clone.unclusteredM = list(self.unclusteredM)
+        return clone
+    
+    def writeImage(self, imageFile):
+        '''
+        writeImage(self, imageFile)
+        -writes the catalog, weights, popularity and name conversions to
+        imageFile for ModelImage and ScoringPool. Run a learner first
+        '''
+        writeModelImage(imageFile, self.seriesList, self.seriesWeights,
+                        self.popularityList, self.seriesDB)
+    
+    def buildCoListing(self, chunkSize = 10000):
+        '''
+        buildCoListing(self, chunkSize = 10000)
+        -builds coListing from M, chunkSize users at a time
+        '''
+        self.coListing = CoListingMatrix()
+        self.coListing.addUsers(self.M, chunkSize)
+        return self.coListing
+    
+    def alsoListed(self, show, k = 10, measure = "pmi", minCount = 1,
+                   standardize = True):
+        '''
+        alsoListed(self, show, k = 10, measure = "pmi", minCount = 1,
+                   standardize = True)
+        -returns the k shows most associated with show as a list of
+        (show, similarity, times listed together). measure is one of "pmi",
+        "cosine", "jaccard" or "count". A minCount above 1 keeps one-off
+        pairs from topping the pmi ranking
+        '''
+        if standardize:
+            show = self.parseTitle(show)
+        if self.coListing is None:
+            self.buildCoListing()
+        return self.coListing.neighbours(show, k, measure, minCount)
+    
+    def proposeMerges(self, redirects = None, minScore = 0.8):
+        '''
+        proposeMerges(self, redirects = None, minScore = 0.8)
+        -returns proposeAliasMerges for the series in the name conversion
+        dictionary and M, using coListing (built if needed) as co-occurrence
+        evidence. See AliasClusters for applying them
+        '''
+        if self.coListing is None:
+            self.buildCoListing()
+        return proposeAliasMerges(self.seriesDB, self.coListing, redirects,
+                                  minScore)
+    
+    def applyAliasClusters(self, clusters):
+        '''
+        applyAliasClusters(self, clusters)
+        -counts every series under the canonical name of its cluster in
+        clusters (an AliasClusters), so split series share one popularity
+        and weight. The submissions as parsed are kept in unclusteredM, so
+        after merging or reverting in clusters calling this again re-maps
+        them without reparsing, and applyAliasClusters(None) goes back to
+        the unclustered data. The model keeps a copy of clusters, so merges
+        made in it afterwards only count once it is applied again. Retrains
+        with the last learner if one was run
+        '''
+        if self.unclusteredM is None:
+            self.unclusteredM = self.M
+        if clusters is None:
+            self.M = self.unclusteredM
+            self.unclusteredM = None
+        else:
+            clusters = copy.deepcopy(clusters)
+            self.M = [[user[0]] + [clusters.canonical(show) for show in user[1:]]
+                      for user in self.unclusteredM]
+        self.aliasClusters = clusters
+        self._buildCatalog()
+        self._dataChanged()
+        if self.coListing is not None:
+            self.buildCoListing()
+        if self.userIndex is not None:
+            self.buildUserIndex()
+        if self.hashedModel is not None:
+            self.hashedLearn(self.hashedModel.buckets)
+        if self.alsModel is not None:
+            self.alsModel.fit(self.M)
+        if self.seriesWeights:
+            if self.weightMethod == "mean":
+                self.naiveLearn()
+            else:
+                self.robustLearn(self.weightMethod, self.trim, self.sketchSize,
+                                 seed = self.sketchSeed)
+    
+    def buildUserIndex(self, numHashes = 144, bands = 48):
+        '''
+        buildUserIndex(self, numHashes = 144, bands = 48)
+        -builds userIndex from M
+        '''
+        self.userIndex = MinHashIndex(numHashes, bands)
+        for user in self.M:
+            self.userIndex.insert(user[1:], user[0])
+        return self.userIndex
+    
+    def knnClassifyScore(self, inputlist, k = 5, standardize = True):
+        '''
+        knnClassifyScore(self, inputlist, k = 5, standardize = True)
+        - given an input list of shows, predicts the total number of shows
+        watched as the similarity weighted average show count of the k most
+        similar anons found by userIndex. If it finds no anon sharing a
+        show with the input it falls back to linearClassifyScore
+        '''
+        if standardize:
+            inputlist = [self.parseTitle(show) for show in inputlist]
+        if self.userIndex is None:
+            self.buildUserIndex()
+        neighbours = self.userIndex.query(inputlist, k)
+        if not neighbours:
+            return self.linearClassifyScore(inputlist, False)
+        score = 0.0
+        total = 0.0
+        for similarity, count in neighbours:
+            score += similarity * count
+            total += similarity
+        return score / total
+    
+    def gridClassifyScore(self, imageFile, coverIndex, maxDistance = 10):
+        '''
+        gridClassifyScore(self, imageFile, coverIndex, maxDistance = 10)
+        - given a 3x3 chart image and a CoverArtIndex, matches each tile to
+        the nearest cover within maxDistance bits and returns
+        linearClassifyScore of the recognized series. Tiles that match
+        nothing are ignored
+        '''
+        names = recognizeGrid(imageFile, coverIndex, maxDistance)
+        return self.linearClassifyScore([name for name in names if name], False)
 
             
         
-
-def parseData(txtfile, dbFile, database):
+class ModelReloader:
     '''
-    parseData(txtfile, dbFile, database)
-    - The textfile is a list of anon's data in the form:
-    power level
-    show 1
-    show 2
-    ...
-    show 9
-    power level
-    show 1
-    ...
-    -the dbFile is a pickled name conversion dictionary
-    -the database is the txtfile with all the names parsed into standard form
-    and in a list
+    ModelReloader(txtFile, dbFile, resolver = None, interval = 2, learn = True)
+    - Keeps a trained NewFagMeter up to date with txtFile and dbFile for
+    long running processes. Call current() for the model to score with; a
+    model that current() has returned is never changed afterwards, so a
+    call that is already running keeps a consistent snapshot while a newer
+    model is swapped in under it. start() polls the files every interval
+    seconds in a background thread, or call check() yourself.
+    
+    On a change the new model is built off to the side and only then
+    published with a single assignment. Where it can, only the affected
+    parts are redone:
+    
+         txtFile appended to
+            - the new records are parsed and added to a copy of the model
+            with addUser, which updates the learned weights in place
+            
+         dbFile only gained names
+            - nothing in the data changes, so a copy of the model just
+            picks up the new names database
+            
+         anything else
+            - the model is rebuilt from scratch (and naiveLearn run, if
+            learn is set)
+    
+    If a rebuild fails the old model stays in place and the error is kept
+    in lastError.
     '''
+    def __init__(self, txtFile, dbFile, resolver = None, interval = 2,
+                 learn = True):
+        self.txtFile = txtFile
+        self.dbFile = dbFile
+        self.resolver = resolver
+        self.interval = interval
+        self.learn = learn
+        self.version = 0
+        self.lastError = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self._rebuild()
     
-    result = []
-    data = open(txtfile, 'r')
-    i = -1
-    for line in data:
-        i += 1
-        if i % 10 == 0:
-            try:
-                dataPoint = [int(line[:-1])] # the number of shows
-            except:
-                sys.stderr.write("input file not valid at line " + str(i))
-                sys.exit(1)
-        elif i % 10 == 9:
-            if dataPoint in result:
-                sys.stderr.write("duplicate detected at line " + str(i))
-                sys.exit(1)               
-            result.append(dataPoint)
-        else:
-            title = parseTitle(line[:-1], dbFile, database)
-            #print "input: " + line[:-1]
-            #print "output: " + title
-            dataPoint.append(title)
-    data.close()
+    def current(self):
+        '''
+        current(self)
+        -returns the current model
+        '''
+        return self.model
     
-    return result        
+    def _fileState(self, filename):
+        stat = os.stat(filename)
+        return (stat.st_mtime, stat.st_size)
+    
+    def _tail(self, size):
+        # the last bytes before size, to tell an append from a rewrite
+        data = open(self.txtFile, 'rb')
+        data.seek(max(0, size - 4096))
+        tail = data.read(size - max(0, size - 4096))
+        data.close()
+        return tail
+    
+    def _rebuild(self):
+        txtState = self._fileState(self.txtFile)
+        dbState = self._fileState(self.dbFile)
+        model = NewFagMeter(self.txtFile, self.dbFile, self.resolver)
+        if self.learn:
+            model.naiveLearn()
+        self._publish(model, txtState, dbState)
+    
+    def _publish(self, model, txtState, dbState):
+        self.txtState = txtState
+        self.dbState = dbState
+        self.txtTail = self._tail(txtState[1])
+        self.dbSnapshot = dict(loadDB(self.dbFile))
+        self.version += 1
+        self.model = model
+    
+    def _appendRecords(self, txtState):
+        # returns the updated copy, or None if this isn't a clean append
+        oldSize = self.txtState[1]
+        if txtState[1] <= oldSize or self._tail(oldSize) != self.txtTail:
+            return None
+        data = open(self.txtFile, 'r')
+        data.seek(oldSize)
+        lines = data.readlines()
+        data.close()
+        if self.txtTail and not self.txtTail.endswith("\n"):
+            if lines[0] != "\n":
+                return None
+            lines = lines[1:]
+        if len(lines) % 10 != 0 or not lines[-1].endswith("\n"):
+            return None
+        model = self.model.copy()
+        known = set([tuple(user) for user in model.M])
+        for user in parseLines(lines, model.seriesDBFile, model.seriesDB, self.resolver):
+            if tuple(user) not in known:
+                known.add(tuple(user))
+                model.addUser(user)
+        return model
+    
+    def _namesOnlyAdded(self):
+        # returns the new names database if it only gained entries
+        database = loadDB(self.dbFile)
+        for title, name in self.dbSnapshot.iteritems():
+            if database.get(title) != name:
+                return None
+        return database
+    
+    def check(self):
+        '''
+        check(self)
+        -reloads if either file has changed since the last load. Returns
+        True if a new model was swapped in
+        '''
+        self.lock.acquire()
+        try:
+            txtState = self._fileState(self.txtFile)
+            dbState = self._fileState(self.dbFile)
+            if txtState == self.txtState and dbState == self.dbState:
+                return False
+            model = None
+            if dbState == self.dbState:
+                model = self._appendRecords(txtState)
+            elif txtState == self.txtState:
+                database = self._namesOnlyAdded()
+                if database is not None:
+                    model = self.model.copy()
+                    model.seriesDB = database
+            if model is not None:
+                self._publish(model, txtState, dbState)
+            else:
+                self._rebuild()
+            self.lastError = None
+            return True
+        except (Exception, SystemExit), error:
+            self.lastError = error
+            return False
+        finally:
+            self.lock.release()
+    
+    def start(self):
+        '''
+        start(self)
+        -starts watching the files in a background thread
+        '''
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target = self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _watch(self):
+        while not self.stopping.wait(self.interval):
+            self.check()
+    
+    def stop(self):
+        '''
+        stop(self)
+        -stops the background thread
+        '''
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
 
-def parseTitle(title, dbFile, database):
+class ImportLedger:
     '''
-    parseTitle(title, dbFile, database)
-    -returns the standardized version of title
+    ImportLedger(ledgerFile = None)
+    - The content hashes of every record imported so far, kept in a set and
+    appended to ledgerFile (one hex digest per line) so later imports skip
+    them too. Without a ledgerFile it only remembers the current run.
     '''
-    title = title.lower()
+    def __init__(self, ledgerFile = None):
+        self.ledgerFile = ledgerFile
+        self.digests = set()
+        self.output = None
+        if ledgerFile is not None and os.path.exists(ledgerFile):
+            data = open(ledgerFile, 'r')
+            for line in data:
+                self.digests.add(line.strip())
+            data.close()
     
-    if title in database.keys():
-        #print "already found :"
-        return database[title]
+    def __contains__(self, digest):
+        return digest in self.digests
     
-    #print "querying google"
-    time.sleep(5)
-    templateURL = "http://www.google.com/search?q="
-
-    url = urllib.urlopen(templateURL + title + "+anime+site:wikipedia.org")
-    source = url.read()
-    start = source.find("http://en.wikipedia.org/wiki/") + 29
-    end = start
-    while source[end] != "&" and source[end] != "%":
-        end += 1
-    if end - start > 100:
-        seriesName = "Unknown"
-        #print "Error, series unknown"
-        #print title
-        sys.exit(1)
-    else:
-        seriesName = source[start:end]
-        
-        #update database and dbFile
-        database[title] = seriesName
-        output = open(dbFile, 'wb')
-        pickle.dump(database, output)
-        output.close()
-        
-    return seriesName
+    def __len__(self):
+        return len(self.digests)
+    
+    def add(self, digest):
+        '''
+        add(self, digest)
+        -records digest as imported
+        '''
+        self.digests.add(digest)
+        if self.ledgerFile is not None:
+            if self.output is None:
+                self.output = open(self.ledgerFile, 'a')
+            self.output.write(digest + "\n")
+    
+    def close(self):
+        '''
+        close(self)
+        -flushes and closes ledgerFile
+        '''
+        if self.output is not None:
+            self.output.close()
+            self.output = None
 
-def convertToInputList(string):
+class UserValidator:
     '''
-    convertToInputList(string):
-    -convert multiline sting of shows into a list
+    UserValidator(lowerBound = 0, upperBound = 5000, blackList = [],
+                  listLength = 9, rejectFile = None)
+    - Checks standardized records ([show count, show, ...]) as they are
+    ingested. The rules are
+    
+         lowerBound / upperBound
+            - the show count must lie between them
+            
+         blacklisted
+            - no show may be in blackList (standardized names, held in a
+            set)
+            
+         duplicate show
+            - no show may be listed twice, e.g. "Lain" and "Serial
+            Experiments Lain". Titles that resolved to "Unknown" aren't
+            compared
+            
+         list length
+            - there must be exactly listLength shows, unless listLength is
+            None
+    
+    counts has how many records broke each rule, plus "accepted" and
+    "rejected". Rejected records are appended to rejectFile, if given, as
+    JSON lines with the source and the reasons.
     '''
-    result = []
-    show = ''
-    for i in string:
-        if i != '\n':
-            show += i
+    def __init__(self, lowerBound = 0, upperBound = 5000, blackList = [],
+                 listLength = 9, rejectFile = None):
+        self.lowerBound = lowerBound
+        self.upperBound = upperBound
+        self.blackList = set(blackList)
+        self.listLength = listLength
+        self.rejectFile = rejectFile
+        self.counts = {"accepted": 0, "rejected": 0, "lowerBound": 0,
+                       "upperBound": 0, "blacklisted": 0,
+                       "duplicate show": 0, "list length": 0}
+        self.output = None
+    
+    def reasons(self, user):
+        '''
+        reasons(self, user)
+        -returns the list of rules user breaks, empty if it is valid
+        '''
+        numberShows = user[0]
+        shows = user[1:]
+        result = []
+        if numberShows < self.lowerBound:
+            result.append("lowerBound")
+        if numberShows > self.upperBound:
+            result.append("upperBound")
+        for show in shows:
+            if show in self.blackList:
+                result.append("blacklisted")
+                break
+        known = [show for show in shows if show != "Unknown"]
+        if len(set(known)) != len(known):
+            result.append("duplicate show")
+        if self.listLength is not None and len(shows) != self.listLength:
+            result.append("list length")
+        return result
+    
+    def check(self, user, source = None):
+        '''
+        check(self, user, source = None)
+        -returns True if user is valid. Otherwise counts the broken rules,
+        writes the record to rejectFile and returns False
+        '''
+        reasons = self.reasons(user)
+        if not reasons:
+            self.counts["accepted"] += 1
+            return True
+        self.counts["rejected"] += 1
+        for reason in reasons:
+            self.counts[reason] += 1
+        if self.rejectFile is not None:
+            if self.output is None:
+                self.output = open(self.rejectFile, 'a')
+            self.output.write(json.dumps({"source": source, "record": user,
+                                          "reasons": reasons}) + "\n")
+        return False
+    
+    def close(self):
+        '''
+        close(self)
+        -closes rejectFile
+        '''
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+class BulkImporter:
+    '''
+    BulkImporter(dbFile, database, ledgerFile = None, resolver = None,
+                 validator = None)
+    - Imports survey data from any number of files in one streaming pass.
+    A source is a filename, whose format comes from its extension, or a
+    (filename, format) pair; the formats are
+    
+         "text"
+            - the parseData format, read by position as parseData does, so
+            a record has the first 8 of its 9 shows just like parseData's
+            (a UserValidator for it wants listLength = 8). "-" separator
+            lines and blank lines are skipped
+            
+         "csv"
+            - one row per anon, show count in the first column and the
+            shows in the rest. A first row without a number is a header
+            
+         "jsonl"
+            - one JSON object per line, {"count": 432, "shows": [...]}
+    
+    Every record is brought to the same form as a row of M, [show count,
+    standardized show, ...], using parseTitle with the given names database
+    and resolver. Its content hash, the sha1 of the count and its sorted
+    standardized shows, is checked against an ImportLedger, so the same
+    list is only imported once however many exports and past imports it
+    turns up in. If a UserValidator is given, new records it rejects are
+    left out in the same pass. Per source counts of what was read,
+    imported, duplicate, malformed and rejected are kept in stats.
+    
+    A record only goes into the ledger once it is stored: importInto enters
+    each one after addUser, and after importAll the caller passes the
+    records it kept to commit. Until then they are only skipped as
+    duplicates within the run.
+    '''
+    formats = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl",
+               ".txt": "text"}
+    
+    def __init__(self, dbFile, database, ledgerFile = None, resolver = None,
+                 validator = None):
+        self.dbFile = dbFile
+        self.database = database
+        self.resolver = resolver
+        self.validator = validator
+        self.ledger = ImportLedger(ledgerFile)
+        self.seen = set()
+        self.stats = {}
+    
+    def records(self, sources):
+        '''
+        records(self, sources)
+        -yields each new standardized record from sources, in order
+        '''
+        for source in sources:
+            if isinstance(source, tuple):
+                filename, format = source
+            else:
+                filename = source
+                extension = os.path.splitext(filename)[1].lower()
+                format = self.formats.get(extension, "text")
+            stats = self.stats.setdefault(filename, {"read": 0, "imported": 0,
+                                                     "duplicate": 0, "malformed": 0,
+                                                     "rejected": 0})
+            reader = {"text": readTextRecords, "csv": readCSVRecords,
+                      "jsonl": readJSONRecords}[format]
+            rows = reader(filename)
+            known = len(self.database)
+            for raw in rows:
+                stats["read"] += 1
+                if raw is None:
+                    stats["malformed"] += 1
+                    continue
+                user = self.standardize(raw)
+                digest = recordDigest(user)
+                if digest in self.ledger or digest in self.seen:
+                    stats["duplicate"] += 1
+                    continue
+                if self.validator is not None and not self.validator.check(user, filename):
+                    stats["rejected"] += 1
+                    continue
+                self.seen.add(digest)
+                stats["imported"] += 1
+                yield user
+            if len(self.database) != known:
+                saveDB(self.database, self.dbFile)
+    
+    def standardize(self, raw):
+        '''
+        standardize(self, raw)
+        -returns a raw (count, titles) record as [count, standardized show,
+        ...]. New names are saved by records, once per source
+        '''
+        count, titles = raw
+        return [count] + [parseTitle(title, self.dbFile, self.database, self.resolver,
+                                     False)
+                          for title in titles]
+    
+    def importAll(self, sources):
+        '''
+        importAll(self, sources)
+        -returns the list of new records from sources. They are not in the
+        ledger until passed to commit
+        '''
+        try:
+            return list(self.records(sources))
+        finally:
+            self.close()
+    
+    def commit(self, users):
+        '''
+        commit(self, users)
+        -enters records from importAll in the ledger, once the caller has
+        stored them
+        '''
+        try:
+            for user in users:
+                self.ledger.add(recordDigest(user))
+        finally:
+            self.ledger.close()
+    
+    def importInto(self, model, sources):
+        '''
+        importInto(self, model, sources)
+        -adds every new record from sources to model with addUser, and
+        returns how many were added. Records already in model count as
+        duplicates
+        '''
+        if model.unclusteredM is not None:
+            self.seen.update(recordDigest(user) for user in model.unclusteredM)
+        else:
+            self.seen.update(recordDigest(user) for user in model.M)
+        added = 0
+        try:
+            for user in self.records(sources):
+                model.addUser(user)
+                self.ledger.add(recordDigest(user))
+                added += 1
+        finally:
+            self.close()
+        return added
+    
+    def close(self):
+        '''
+        close(self)
+        -closes the ledger and the validator's reject file
+        '''
+        self.ledger.close()
+        if self.validator is not None:
+            self.validator.close()
+
+def recordDigest(user):
+    '''
+    recordDigest(user)
+    -returns the content hash of a standardized record: the sha1 of its
+    show count and sorted shows. "Unknown" shows are left out, as addUser
+    leaves them out of M
+    '''
+    shows = sorted(show for show in user[1:] if show != "Unknown")
+    return hashlib.sha1(str(user[0]) + "\n" + "\n".join(shows)).hexdigest()
+
+def readTextRecords(filename):
+    '''
+    readTextRecords(filename)
+    -yields (count, titles) for each record of a parseData style text file,
+    or None for a record that doesn't start with a show count. A record is
+    read by position like parseData reads it: the show count line and the
+    9 lines after it, so a title that is a number, like "86", is still a
+    title, and only the first 8 titles are kept, as parseData keeps them.
+    A "-" line ends a record early
+    '''
+    data = open(filename, 'r')
+    record = None
+    lines = 0
+    orphan = False
+    for line in data:
+        line = line.strip()
+        if not line:
+            continue
+        if line == "-":
+            if record is not None:
+                yield record
+            record = None
+            orphan = False
+            continue
+        if record is not None:
+            lines += 1
+            if lines < 9:
+                record[1].append(line)
+            else:
+                # parseData ends the record here without reading the title
+                yield record
+                record = None
+            continue
+        try:
+            record = (int(line), [])
+        except ValueError:
+            if not orphan:
+                # titles with no show count before them
+                yield None
+                orphan = True
+            continue
+        lines = 0
+        orphan = False
+    if record is not None:
+        yield record
+    data.close()
+
+def readCSVRecords(filename):
+    '''
+    readCSVRecords(filename)
+    -yields (count, titles) for each row of a CSV export, or None for a
+    row whose first column isn't a show count
+    '''
+    data = open(filename, 'rb')
+    for i, row in enumerate(csv.reader(data)):
+        if not row:
+            continue
+        record = parseCSVRow(row)
+        if record is not None or i != 0:
+            yield record
+    data.close()
+
+def parseCSVRow(row):
+    '''
+    parseCSVRow(row)
+    -returns (count, titles) for one CSV row, or None if its first column
+    isn't a show count
+    '''
+    try:
+        count = int(row[0].strip())
+    except ValueError:
+        return None
+    return count, [cell.strip() for cell in row[1:] if cell.strip()]
+
+def readJSONRecords(filename):
+    '''
+    readJSONRecords(filename)
+    -yields (count, titles) for each line of a JSON lines export, or None
+    for a line that isn't a {"count": ..., "shows": [...]} object
+    '''
+    data = open(filename, 'r')
+    for line in data:
+        if not line.strip():
+            continue
+        yield parseJSONRecord(line)
+    data.close()
+
+def parseJSONRecord(line):
+    '''
+    parseJSONRecord(line)
+    -returns (count, titles) for one {"count": ..., "shows": [...]} line,
+    or None if it isn't one
+    '''
+    try:
+        entry = json.loads(line)
+        count = int(entry["count"])
+        titles = [title.encode("utf-8") if isinstance(title, unicode) else str(title)
+                  for title in entry["shows"]]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return count, titles
+
+class SubmissionTail:
+    '''
+    SubmissionTail(filename, format, offset = 0, listLength = 9)
+    - Follows one append-only submission file from byte offset, which must
+    be the start of a record. Each poll() reads whatever complete lines have
+    been appended since the last one and returns the records finished so
+    far as (start, end, record) with their byte offsets in the file; record
+    is (count, titles) as from the readers, or None if malformed. A line
+    still being written is left for the next poll. format is "text",
+    "csv" or "jsonl" as for BulkImporter; a text record is its show count
+    line and the listLength titles after it, or ends early at a "-" line
+    (with listLength None, at the next show count line).
+    If the file shrinks it is read again from the start.
+    '''
+    def __init__(self, filename, format, offset = 0, listLength = 9):
+        self.filename = filename
+        self.format = format
+        self.offset = offset
+        self.listLength = listLength
+        self.pending = None
+        self.orphan = False
+    
+    def poll(self):
+        '''
+        poll(self)
+        -returns the records finished since the last poll
+        '''
+        records = []
+        if not os.path.exists(self.filename):
+            return records
+        if os.path.getsize(self.filename) < self.offset:
+            self.offset = 0
+            self.pending = None
+        data = open(self.filename, 'rb')
+        data.seek(self.offset)
+        while True:
+            start = data.tell()
+            line = data.readline()
+            if not line.endswith("\n"):
+                break
+            self._line(line, start, data.tell(), records)
+        data.close()
+        if self.pending is None:
+            self.offset = start
+        else:
+            # an unfinished text record is read again from its start
+            self.offset = self.pending[0]
+            self.pending = None
+        return records
+    
+    def _line(self, line, start, end, records):
+        if self.format == "jsonl":
+            if line.strip():
+                records.append((start, end, parseJSONRecord(line)))
+            return
+        if self.format == "csv":
+            row = next(csv.reader([line]), None)
+            if row:
+                record = parseCSVRow(row)
+                if record is not None or start != 0:
+                    records.append((start, end, record))
+            return
+        line = line.strip()
+        if not line:
+            return
+        if line == "-":
+            self._finish(start, records)
+            self.orphan = False
+            return
+        if self.pending is not None and self.listLength is not None:
+            # read by position like readTextRecords, so "86" is a title
+            self.pending[2].append(line)
+            if len(self.pending[2]) == self.listLength:
+                self._finish(end, records)
+            return
+        try:
+            count = int(line)
+        except ValueError:
+            if self.pending is None:
+                # titles with no show count before them
+                if not self.orphan:
+                    records.append((start, end, None))
+                    self.orphan = True
+                return
+            self.pending[2].append(line)
+            if self.listLength is not None and len(self.pending[2]) == self.listLength:
+                self._finish(end, records)
+            return
+        self._finish(start, records)
+        self.orphan = False
+        self.pending = (start, count, [])
+    
+    def _finish(self, end, records):
+        if self.pending is not None:
+            start, count, titles = self.pending
+            records.append((start, end, (count, titles)))
+            self.pending = None
+
+class IngestDaemon:
+    '''
+    IngestDaemon(model, source, checkpointFile = None, storeFile = None,
+                 ledgerFile = None, resolver = None, validator = None,
+                 format = None, batchSize = 100, batchSeconds = 2.0,
+                 maxPending = 1000, pollInterval = 0.5)
+    - Feeds new survey submissions into a live NewFagMeter as they arrive.
+    source is one of
+    
+         a file
+            - followed like tail -f (see SubmissionTail), its format from
+            format or its extension as for BulkImporter
+            
+         a directory
+            - every file in it, including ones that turn up later, followed
+            in name order
+            
+         ("unix", path) or ("tcp", host, port)
+            - a local socket that takes any number of connections, each
+            sending {"count": ..., "shows": [...]} JSON lines
+    
+    A reader thread puts the submissions on a queue of at most maxPending;
+    when the queue is full the reader waits, so files are simply read later
+    and socket senders are held up by the socket's own flow control. That
+    is the backpressure when resolving titles falls behind.
+    
+    A committer thread takes batches off the queue: up to batchSize
+    submissions, or whatever arrived within batchSeconds of the first one.
+    A batch's titles are resolved together by resolver (a BatchResolver,
+    by default one around the model's resolver), which only looks up titles
+    not already in the names database and writes new names to it in
+    batches. Titles are then mapped through the model's alias clusters,
+    checked against the ledger (an ImportLedger, so a submission is never
+    counted twice) and the validator (a UserValidator), and the accepted
+    ones are added to the model with addUser and appended to storeFile,
+    the raw titles in the data.txt format (or JSON lines if storeFile ends
+    in .jsonl). A data.txt store only takes submissions of exactly 9 titles,
+    as that is what parseData reads back; others are rejected. Submissions
+    whose lookup failed are kept for the next batch.
+    Finally the read offset of every file, up to the last submission that is
+    fully dealt with, is written to checkpointFile, so a restarted daemon
+    carries on where it left off (a crash can re-read the last batch; the
+    ledger drops what had already been taken).
+    
+    lock is held while a batch is added to the model. stats counts what
+    happened: read, malformed, duplicate, rejected, committed, retried,
+    batches and backpressure (how many times the reader had to wait).
+    '''
+    def __init__(self, model, source, checkpointFile = None, storeFile = None,
+                 ledgerFile = None, resolver = None, validator = None,
+                 format = None, batchSize = 100, batchSeconds = 2.0,
+                 maxPending = 1000, pollInterval = 0.5):
+        self.model = model
+        self.source = source
+        self.checkpointFile = checkpointFile
+        self.storeFile = storeFile
+        self.ledger = ImportLedger(ledgerFile)
+        if resolver is None:
+            resolver = BatchResolver(model.resolver)
+        self.resolver = resolver
+        self.validator = validator
+        self.format = format
+        self.batchSize = batchSize
+        self.batchSeconds = batchSeconds
+        self.pollInterval = pollInterval
+        self.queue = Queue.Queue(maxPending)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.listener = None
+        self.tails = {}
+        self.retry = []
+        self.offsets = {}
+        if checkpointFile is not None and os.path.exists(checkpointFile):
+            data = open(checkpointFile, 'r')
+            self.offsets = dict((_jsonStr(name), offset) for (name, offset)
+                                in json.load(data)["offsets"].iteritems())
+            data.close()
+        self.stats = {"read": 0, "malformed": 0, "duplicate": 0, "rejected": 0,
+                      "committed": 0, "retried": 0, "batches": 0, "backpressure": 0}
+    
+    def _formatOf(self, filename):
+        if self.format is not None:
+            return self.format
+        extension = os.path.splitext(filename)[1].lower()
+        return BulkImporter.formats.get(extension, "text")
+    
+    def _files(self):
+        if os.path.isdir(self.source):
+            return [os.path.join(self.source, name) for name in sorted(os.listdir(self.source))
+                    if os.path.isfile(os.path.join(self.source, name))]
+        return [self.source]
+    
+    def _newRecords(self):
+        # yields (file, start, end, record) for what the files have gained
+        listLength = 9
+        if self.validator is not None:
+            listLength = self.validator.listLength
+        for filename in self._files():
+            tail = self.tails.get(filename)
+            if tail is None:
+                tail = SubmissionTail(filename, self._formatOf(filename),
+                                      self.offsets.get(filename, 0), listLength)
+                self.tails[filename] = tail
+            for start, end, record in tail.poll():
+                self.stats["read"] += 1
+                yield filename, start, end, record
+    
+    def _put(self, item):
+        # waits while the queue is full, giving up only when stopping
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            self.stats["backpressure"] += 1
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout = self.pollInterval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    def _readFiles(self):
+        while not self.stopping.is_set():
+            found = False
+            for item in self._newRecords():
+                found = True
+                if not self._put(item):
+                    return
+            if not found:
+                self.stopping.wait(self.pollInterval)
+    
+    def _listen(self):
+        while not self.stopping.is_set():
+            try:
+                connection, address = self.listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target = self._readConnection, args = (connection,))
+            thread.daemon = True
+            thread.start()
+    
+    def _readConnection(self, connection):
+        stream = connection.makefile('rb')
+        try:
+            for line in stream:
+                if line.strip():
+                    self.stats["read"] += 1
+                    if not self._put((None, None, None, parseJSONRecord(line))):
+                        break
+        except socket.error:
+            pass
+        stream.close()
+        connection.close()
+    
+    def _nextBatch(self, wait):
+        batch = self.retry
+        self.retry = []
+        deadline = None
+        if batch:
+            deadline = time.time()
+        while len(batch) < self.batchSize:
+            try:
+                if deadline is None:
+                    if not wait:
+                        item = self.queue.get_nowait()
+                    else:
+                        item = self.queue.get(timeout = self.pollInterval)
+                else:
+                    remaining = deadline + self.batchSeconds - time.time()
+                    if remaining <= 0 or not wait:
+                        item = self.queue.get_nowait()
+                    else:
+                        item = self.queue.get(timeout = remaining)
+            except Queue.Empty:
+                if deadline is not None or not wait or self.stopping.is_set():
+                    break
+                continue
+            if deadline is None:
+                deadline = time.time()
+            batch.append(item)
+        return batch
+    
+    def commit(self, batch):
+        '''
+        commit(self, batch)
+        -resolves, checks and adds a batch of (file, start, end, record)
+        items and moves the checkpoint past them. Returns how many
+        submissions were added to the model
+        '''
+        titles = []
+        for filename, start, end, record in batch:
+            if record is not None:
+                titles.extend(record[1])
+        self.resolver.failures = {}
+        resolved = self.resolver.resolveAll(titles, self.model.seriesDBFile,
+                                            self.model.seriesDB)
+        clusters = self.model.aliasClusters
+        textStore = self.storeFile is not None and not self.storeFile.endswith(".jsonl")
+        accepted = []
+        retry = []
+        for item in batch:
+            filename, start, end, record = item
+            if record is None:
+                self.stats["malformed"] += 1
+                continue
+            count, raw = record
+            if textStore and len(raw) != 9:
+                # parseData reads the store as a count and 9 titles, so any
+                # other length would shift every record written after it
+                self.stats["rejected"] += 1
+                continue
+            if [title for title in raw if title.lower() not in resolved]:
+                retry.append(item)
+                continue
+            user = [count] + [resolved[title.lower()] for title in raw]
+            if clusters is not None:
+                user = [count] + [clusters.canonical(show) for show in user[1:]]
+            digest = recordDigest(user)
+            if digest in self.ledger:
+                self.stats["duplicate"] += 1
+                continue
+            if self.validator is not None and not self.validator.check(user, filename):
+                self.stats["rejected"] += 1
+                continue
+            accepted.append((user, record, digest))
+        self.lock.acquire()
+        try:
+            for user, record, digest in accepted:
+                self.model.addUser(user)
+        finally:
+            self.lock.release()
+        if accepted and self.storeFile is not None:
+            output = open(self.storeFile, 'a+')
+            output.seek(0, 2)
+            if output.tell() > 0:
+                output.seek(-1, 2)
+                if output.read(1) != "\n":
+                    # data.txt doesn't end in a newline, so the first count
+                    # would be glued to its last title
+                    output.seek(0, 2)
+                    output.write("\n")
+            for user, (count, raw), digest in accepted:
+                if not textStore:
+                    output.write(json.dumps({"count": count, "shows": raw}) + "\n")
+                else:
+                    output.write(str(count) + "\n" + "".join([title + "\n" for title in raw]))
+            output.close()
+        for user, record, digest in accepted:
+            self.ledger.add(digest)
+        if self.ledger.output is not None:
+            self.ledger.output.flush()
+        self.stats["committed"] += len(accepted)
+        self.stats["retried"] += len(retry)
+        self.stats["batches"] += 1
+        self.retry = retry + self.retry
+        self._checkpoint(batch)
+        return len(accepted)
+    
+    def _checkpoint(self, batch):
+        # a file's offset moves to the end of its last submission in the
+        # batch, but never past a submission still waiting to be retried
+        for filename, start, end, record in batch:
+            if filename is not None:
+                self.offsets[filename] = max(self.offsets.get(filename, 0), end)
+        for filename, start, end, record in self.retry:
+            if filename is not None:
+                self.offsets[filename] = min(self.offsets[filename], start)
+        if self.checkpointFile is not None:
+            output = open(self.checkpointFile + ".tmp", 'w')
+            json.dump({"offsets": self.offsets}, output)
+            output.close()
+            os.rename(self.checkpointFile + ".tmp", self.checkpointFile)
+    
+    def _commitLoop(self):
+        while not self.stopping.is_set() or not self.queue.empty():
+            batch = self._nextBatch(not self.stopping.is_set())
+            if not batch:
+                continue
+            retrying = len(self.retry)
+            if self.commit(batch) == 0 and len(self.retry) >= len(batch) - retrying:
+                # nothing got through, most likely the resolver is down
+                self.stopping.wait(self.pollInterval)
+            if self.stopping.is_set() and len(self.retry) == len(batch):
+                break
+    
+    def poll(self):
+        '''
+        poll(self)
+        -without threads: reads what the files have gained and commits it
+        in batches of batchSize. Returns how many submissions were added
+        '''
+        added = 0
+        batch = self.retry
+        self.retry = []
+        for item in self._newRecords():
+            batch.append(item)
+            if len(batch) >= self.batchSize:
+                added += self.commit(batch)
+                batch = []
+        if batch:
+            added += self.commit(batch)
+        return added
+    
+    def start(self):
+        '''
+        start(self)
+        -starts the reader and committer threads
+        '''
+        if self.threads:
+            return
+        self.stopping.clear()
+        if isinstance(self.source, tuple):
+            if self.source[0] == "unix":
+                if os.path.exists(self.source[1]):
+                    os.remove(self.source[1])
+                self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.listener.bind(self.source[1])
+            else:
+                self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.listener.bind((self.source[1], self.source[2]))
+            self.listener.listen(16)
+            reader = self._listen
+        else:
+            reader = self._readFiles
+        self.threads = [threading.Thread(target = reader),
+                        threading.Thread(target = self._commitLoop)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+    
+    def stop(self):
+        '''
+        stop(self)
+        -stops reading, commits what is already queued and stops the
+        threads, then closes the ledger and the validator's reject file
+        '''
+        self.stopping.set()
+        if self.listener is not None:
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.listener.close()
+            self.listener = None
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.ledger.close()
+        if self.validator is not None:
+            self.validator.close()
+
+class ScoreEntry:
+    '''
+    ScoreEntry(score, binaryClass, popularity)
+    - A cached scoring result: the predicted show count, the binary class
+    (1 or -1), the average popularity, and hits, how many times the entry
+    has been served from the cache
+    '''
+    def __init__(self, score, binaryClass, popularity):
+        self.score = score
+        self.binaryClass = binaryClass
+        self.popularity = popularity
+        self.hits = 0
+    
+    def __repr__(self):
+        return "ScoreEntry(%r, %r, %r, hits = %r)" % (self.score, self.binaryClass,
+                                                      self.popularity, self.hits)
+
+class ScoreReport:
+    '''
+    ScoreReport(weights, hitList, missList)
+    - Everything NewFagMeter.scoreReport works out for one list: score
+    (the predicted show count), binaryClass (1 or -1), popularity (the
+    average), weights ((show, weight) for each known show), hitList (the
+    standardized known shows), missList (the input titles that weren't
+    known) and coverage (the fraction of titles that were known)
+    '''
+    def __init__(self, weights, hitList, missList):
+        self.score = None
+        self.binaryClass = -1
+        self.popularity = None
+        self.weights = weights
+        self.hitList = hitList
+        self.missList = missList
+        total = len(hitList) + len(missList)
+        if total:
+            self.coverage = len(hitList) / float(total)
+        else:
+            self.coverage = 0.0
+    
+    def __repr__(self):
+        return ("ScoreReport(score = %r, binaryClass = %r, popularity = %r, "
+                "coverage = %r, missList = %r)" % (self.score, self.binaryClass,
+                                                    self.popularity, self.coverage,
+                                                    self.missList))
+
+def _alsHalfStep(indptr, indices, other, regularization, alpha, blockEntries):
+    # solves every row of a CSR incidence (indptr, indices) against the
+    # fixed factors of the other side. Rows are sorted by length and solved
+    # in blocks of at most blockEntries padded entries, and at most
+    # blockEntries / k^2 rows so the block's k x k systems are no bigger,
+    # each block as one stacked matmul and one batched solve; rows longer
+    # than that are done alone, their gram matrix summed blockEntries
+    # entries at a time
+    import numpy
+    rows = len(indptr) - 1
+    k = other.shape[1]
+    maxRows = max(1, blockEntries // (k * k))
+    gram = other.T.dot(other) + regularization * numpy.eye(k)
+    result = numpy.zeros((rows, k))
+    lengths = numpy.diff(indptr)
+    order = numpy.argsort(lengths, kind = "mergesort")
+    order = order[lengths[order] > 0]
+    sortedLengths = lengths[order]
+    start = 0
+    while start < len(order):
+        shortest = sortedLengths[start]
+        if shortest > blockEntries:
+            for row in order[start:]:
+                result[row] = _alsSolveRow(indices[indptr[row]:indptr[row + 1]], other,
+                                           gram, alpha, blockEntries)
+            break
+        stop = min(len(order), start + blockEntries // shortest, start + maxRows)
+        longest = sortedLengths[stop - 1]
+        if longest * (stop - start) > blockEntries:
+            stop = start + max(1, blockEntries // longest)
+            longest = sortedLengths[stop - 1]
+        block = order[start:stop]
+        positions = numpy.arange(longest)
+        mask = positions[None, :] < lengths[block][:, None]
+        offsets = numpy.where(mask, indptr[block][:, None] + positions[None, :], 0)
+        stacked = other[indices[offsets]] * mask[:, :, None]
+        A = gram + alpha * numpy.matmul(stacked.transpose(0, 2, 1), stacked)
+        b = (1 + alpha) * stacked.sum(axis = 1)
+        result[block] = numpy.linalg.solve(A, b[:, :, None])[:, :, 0]
+        start = stop
+    return result
+
+def _alsSolveRow(columns, other, gram, alpha, blockEntries):
+    # one row of _alsHalfStep: (gram + alpha Y_u'Y_u) x = (1 + alpha) Y_u'1
+    import numpy
+    A = gram.copy()
+    b = numpy.zeros(other.shape[1])
+    for start in xrange(0, len(columns), blockEntries):
+        chunk = other[columns[start:start + blockEntries]]
+        A += alpha * chunk.T.dot(chunk)
+        b += chunk.sum(axis = 0)
+    return numpy.linalg.solve(A, (1 + alpha) * b)
+
+class ALSModel:
+    '''
+    ALSModel(factors = 32, regularization = 0.1, alpha = 40.0,
+             iterations = 10, blockEntries = 65536, seed = 0)
+    - Implicit feedback matrix factorization (Hu, Koren and Volinsky) of
+    the anon x series incidence: every listing is a 1 seen with confidence
+    1 + alpha, every other cell a 0 with confidence 1, and alternating least
+    squares fits anon and series embeddings of factors numbers each. Each
+    half step solves all rows of one side in blocks (see _alsHalfStep), so
+    the python overhead is per block rather than per anon; the gram and
+    stacked products and the batched solves all run in numpy's BLAS and
+    LAPACK, which use as many threads as it is built with
+    (OPENBLAS_NUM_THREADS / MKL_NUM_THREADS).
+    
+    Once fitted, a list of shows folds into an anon embedding with one
+    k x k solve against the fixed series embeddings (foldIn), and a ridge
+    regression from anon embeddings to log(1 + show count) turns that into
+    a predicted show count. The regression is kept as its normal equations,
+    so addUser and removeUser fold anons in and out of it without refitting
+    the factorization. Series no one listed at fit time are unknown.
+    
+    Fields: seriesList, seriesIndex (name to row of seriesFactors),
+    seriesFactors, userFactors (one row per anon fitted, in order) and
+    countWeights (the regression, last entry the intercept).
+    '''
+    def __init__(self, factors = 32, regularization = 0.1, alpha = 40.0,
+                 iterations = 10, blockEntries = 65536, seed = 0):
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.blockEntries = blockEntries
+        self.seed = seed
+        self.seriesList = []
+        self.seriesIndex = {}
+        self.seriesFactors = None
+        self.userFactors = None
+        self.gram = None
+        self.normal = None
+        self.target = None
+        self.countWeights = None
+    
+    def fit(self, users):
+        '''
+        fit(self, users)
+        -fits the factorization and the show count regression to parsed
+        submissions [show count, show 1, ...], such as M
+        '''
+        import numpy
+        self.seriesList = []
+        self.seriesIndex = {}
+        indptr = [0]
+        indices = []
+        for user in users:
+            for show in set(user[1:]):
+                if show == "Unknown":
+                    continue
+                j = self.seriesIndex.get(show)
+                if j is None:
+                    j = self.seriesIndex[show] = len(self.seriesList)
+                    self.seriesList.append(show)
+                indices.append(j)
+            indptr.append(len(indices))
+        indptr = numpy.array(indptr, dtype = numpy.intp)
+        indices = numpy.array(indices, dtype = numpy.intp)
+        rows = numpy.repeat(numpy.arange(len(users)), numpy.diff(indptr))
+        order = numpy.argsort(indices, kind = "mergesort")
+        seriesIndices = rows[order]
+        seriesIndptr = numpy.concatenate(([0], numpy.cumsum(
+            numpy.bincount(indices, minlength = len(self.seriesList)))))
+        rand = numpy.random.RandomState(self.seed)
+        Y = rand.normal(0, 0.01, (len(self.seriesList), self.factors))
+        for iteration in xrange(self.iterations):
+            X = _alsHalfStep(indptr, indices, Y, self.regularization, self.alpha,
+                             self.blockEntries)
+            Y = _alsHalfStep(seriesIndptr, seriesIndices, X, self.regularization,
+                             self.alpha, self.blockEntries)
+        # one more anon step against the final series factors, so every
+        # fitted anon's embedding is exactly what foldIn gives for their list
+        self.seriesFactors = Y
+        self.gram = Y.T.dot(Y) + self.regularization * numpy.eye(self.factors)
+        self.userFactors = _alsHalfStep(indptr, indices, Y, self.regularization,
+                                        self.alpha, self.blockEntries)
+        features = numpy.hstack((self.userFactors, numpy.ones((len(users), 1))))
+        counts = numpy.log1p(numpy.array([user[0] for user in users], dtype = numpy.float64))
+        self.normal = features.T.dot(features)
+        self.target = features.T.dot(counts)
+        self._solveCounts()
+    
+    def _solveCounts(self):
+        import numpy
+        ridge = self.regularization * numpy.eye(self.factors + 1)
+        ridge[-1, -1] = 0
+        self.countWeights = numpy.linalg.lstsq(self.normal + ridge, self.target,
+                                               rcond = None)[0]
+    
+    def foldIn(self, shows):
+        '''
+        foldIn(self, shows)
+        -returns the embedding of an anon listing shows, or None if none of
+        them are known
+        '''
+        import numpy
+        columns = [self.seriesIndex[show] for show in set(shows) if show in self.seriesIndex]
+        if not columns:
+            return None
+        return _alsSolveRow(numpy.array(columns, dtype = numpy.intp), self.seriesFactors,
+                            self.gram, self.alpha, self.blockEntries)
+    
+    def predictCount(self, shows):
+        '''
+        predictCount(self, shows)
+        -returns the predicted show count of an anon listing shows, None if
+        none of them are known
+        '''
+        import numpy
+        x = self.foldIn(shows)
+        if x is None:
+            return None
+        return float(numpy.expm1(x.dot(self.countWeights[:-1]) + self.countWeights[-1]))
+    
+    def _updateCounts(self, user, sign):
+        import numpy
+        x = self.foldIn(user[1:])
+        if x is None:
+            return
+        feature = numpy.append(x, 1.0)
+        self.normal += sign * numpy.outer(feature, feature)
+        self.target += sign * math.log1p(user[0]) * feature
+        self._solveCounts()
+    
+    def addUser(self, user):
+        '''
+        addUser(self, user)
+        -folds a new parsed submission into the show count regression. The
+        series embeddings stay as fitted
+        '''
+        self._updateCounts(user, 1)
+    
+    def removeUser(self, user):
+        '''
+        removeUser(self, user)
+        -takes a submission back out of the show count regression
+        '''
+        self._updateCounts(user, -1)
+    
+    def similarSeries(self, show, k = 10):
+        '''
+        similarSeries(self, show, k = 10)
+        -returns the k series whose embeddings are closest (cosine) to
+        show's, as a list of (series, similarity)
+        '''
+        import numpy
+        j = self.seriesIndex.get(show)
+        if j is None:
+            return []
+        norms = numpy.sqrt((self.seriesFactors ** 2).sum(axis = 1))
+        norms[norms == 0] = 1
+        similarity = self.seriesFactors.dot(self.seriesFactors[j]) / (norms * norms[j])
+        similarity[j] = -numpy.inf
+        best = numpy.argsort(-similarity)[:k]
+        return [(self.seriesList[i], float(similarity[i])) for i in best]
+
+class HashedFeatureModel:
+    '''
+    HashedFeatureModel(buckets = 65536)
+    - Series weights kept in a fixed number of buckets, a series going to
+    bucket crc32(name) % buckets. Each bucket holds the sum and count of the
+    show counts of anons listing a series in it, so its weight is their
+    average, and it remembers the first series it saw plus up to
+    maxSamples others, so collisions can be reported. Nothing grows with
+    the number of distinct titles: new titles just land in a bucket.
+    '''
+    maxSamples = 3
+    
+    def __init__(self, buckets = 65536):
+        self.buckets = buckets
+        self.totals = [0.0] * buckets
+        self.counts = [0] * buckets
+        self.names = [None] * buckets
+        self.collisions = {}
+    
+    def bucketOf(self, show):
+        '''
+        bucketOf(self, show)
+        -returns the bucket show hashes to
+        '''
+        return (zlib.crc32(show) & 0xffffffff) % self.buckets
+    
+    def _note(self, bucket, show):
+        first = self.names[bucket]
+        if first is None:
+            self.names[bucket] = show
+        elif first != show:
+            others = self.collisions.setdefault(bucket, [])
+            if show not in others and len(others) < self.maxSamples:
+                others.append(show)
+    
+    def add(self, user):
+        '''
+        add(self, user)
+        -counts a parsed submission [show count, show 1, ...]. A bucket
+        listed twice by one anon counts once
+        '''
+        buckets = set()
+        for show in user[1:]:
+            if show == "Unknown":
+                continue
+            bucket = self.bucketOf(show)
+            self._note(bucket, show)
+            buckets.add(bucket)
+        for bucket in buckets:
+            self.totals[bucket] += user[0]
+            self.counts[bucket] += 1
+    
+    def remove(self, user):
+        '''
+        remove(self, user)
+        -takes a submission added with add back out. Which series a bucket
+        has seen is not forgotten
+        '''
+        for bucket in set(self.bucketOf(show) for show in user[1:] if show != "Unknown"):
+            self.totals[bucket] -= user[0]
+            self.counts[bucket] -= 1
+    
+    def weight(self, show):
+        '''
+        weight(self, show)
+        -returns the weight of show's bucket, None if the bucket is empty
+        '''
+        bucket = self.bucketOf(show)
+        if self.counts[bucket] == 0:
+            return None
+        return self.totals[bucket] / self.counts[bucket]
+    
+    def score(self, shows):
+        '''
+        score(self, shows)
+        -returns the average weight of the buckets of shows, skipping empty
+        ones, or None if they're all empty
+        '''
+        score = 0.0
+        total = 0
+        for show in shows:
+            weight = self.weight(show)
+            if weight is not None:
+                score += weight
+                total += 1
+        if total == 0:
+            return None
+        return score / total
+    
+    def collidingBuckets(self):
+        '''
+        collidingBuckets(self)
+        -returns (bucket, series seen in it, anons counted in it) for every
+        bucket more than one series has hashed to, the most listed first.
+        At most maxSamples + 1 series are named per bucket
+        '''
+        result = [(bucket, [self.names[bucket]] + others, self.counts[bucket])
+                  for (bucket, others) in self.collisions.iteritems()]
+        result.sort(key = lambda entry: (-entry[2], entry[0]))
+        return result
+    
+    def usedBuckets(self):
+        '''
+        usedBuckets(self)
+        -returns how many buckets have ever had a series in them
+        '''
+        return self.buckets - self.names.count(None)
+
+class LeaveOneOutReport:
+    '''
+    LeaveOneOutReport(actual, predictions, binaryThreshold, unscored)
+    - What NewFagMeter.leaveOneOut works out: predictions (the left out
+    show count prediction for each anon, in the order of M), actual (their
+    show counts), unscored (how many anons had no series anyone else listed
+    and got the mean instead), binaryError (the percent classified wrong at
+    binaryThreshold, comparable to binaryISE), meanAbsoluteError and
+    rootMeanSquaredError. Anons with no prediction at all (a model of one
+    anon) are left out of the errors
+    '''
+    def __init__(self, actual, predictions, binaryThreshold, unscored):
+        self.actual = actual
+        self.predictions = predictions
+        self.unscored = unscored
+        pairs = [(a, p) for (a, p) in zip(actual, predictions) if p is not None]
+        self.binaryError = None
+        self.meanAbsoluteError = None
+        self.rootMeanSquaredError = None
+        if pairs:
+            wrong = sum(1 for (a, p) in pairs
+                        if (a >= binaryThreshold) != (p >= binaryThreshold))
+            self.binaryError = wrong * 100.0 / len(pairs)
+            self.meanAbsoluteError = sum(abs(a - p) for (a, p) in pairs) / len(pairs)
+            self.rootMeanSquaredError = math.sqrt(sum((a - p) ** 2 for (a, p) in pairs)
+                                                  / len(pairs))
+    
+    def __repr__(self):
+        return ("LeaveOneOutReport(binaryError = %r, meanAbsoluteError = %r, "
+                "rootMeanSquaredError = %r, unscored = %r)" %
+                (self.binaryError, self.meanAbsoluteError,
+                 self.rootMeanSquaredError, self.unscored))
+
+class ScoreCache:
+    '''
+    ScoreCache(maxSize = 10000)
+    - A least recently used cache of scoring results, holding at most
+    maxSize entries. Every get and put names the model version the result
+    belongs to; as soon as that changes everything cached is dropped, so a
+    retrained model never serves an old score. hits, misses, evictions and
+    invalidations count what happened.
+    '''
+    def __init__(self, maxSize = 10000):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def _checkVersion(self, version):
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+    
+    def get(self, key, version):
+        '''
+        get(self, key, version)
+        -returns the entry for key, or None
+        '''
+        self._checkVersion(version)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        entry.hits += 1
+        self.hits += 1
+        return entry
+    
+    def put(self, key, version, entry):
+        '''
+        put(self, key, version, entry)
+        -stores entry under key, evicting the least recently used entry if
+        the cache is full
+        '''
+        self._checkVersion(version)
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+    
+    def stats(self):
+        '''
+        stats(self)
+        -returns a dict of the counters and the hit rate
+        '''
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations, "size": len(self.entries),
+                "hitRate": self.hits / float(lookups) if lookups else 0.0}
+
+class ShowCountStats:
+    '''
+    ShowCountStats(counts = [])
+    - Order statistics over show counts. The counts are kept in a sorted
+    list along with their running total, so the mean, median and any
+    percentile are O(1), counting below a value is O(log n), and a histogram
+    is O(bins log n). add and remove find their place with a binary search.
+    '''
+    def __init__(self, counts = []):
+        self.counts = sorted(counts)
+        self.total = sum(self.counts)
+    
+    def __len__(self):
+        return len(self.counts)
+    
+    def add(self, count):
+        '''
+        add(self, count)
+        -adds one show count
+        '''
+        bisect.insort(self.counts, count)
+        self.total += count
+    
+    def remove(self, count):
+        '''
+        remove(self, count)
+        -removes one occurrence of count, raises ValueError if absent
+        '''
+        i = bisect.bisect_left(self.counts, count)
+        if i == len(self.counts) or self.counts[i] != count:
+            raise ValueError("show count not present: " + str(count))
+        del self.counts[i]
+        self.total -= count
+    
+    def mean(self):
+        '''
+        mean(self)
+        -returns the mean show count
+        '''
+        return self.total / float(len(self.counts))
+    
+    def median(self):
+        '''
+        median(self)
+        -returns the median show count. For an even number of counts this
+        is the mean of the middle two
+        '''
+        return self.percentile(50)
+    
+    def percentile(self, p):
+        '''
+        percentile(self, p)
+        -returns the p'th percentile, interpolating linearly between the
+        closest ranks
+        '''
+        n = len(self.counts)
+        if n == 0:
+            raise ValueError("no show counts")
+        position = (n - 1) * p / 100.0
+        low = int(position)
+        if low >= n - 1:
+            return self.counts[-1]
+        fraction = position - low
+        if fraction == 0:
+            return self.counts[low]
+        return self.counts[low] + (self.counts[low + 1] - self.counts[low]) * fraction
+    
+    def rank(self, count):
+        '''
+        rank(self, count)
+        -returns how many show counts are strictly below count
+        '''
+        return bisect.bisect_left(self.counts, count)
+    
+    def histogram(self, edges):
+        '''
+        histogram(self, edges)
+        -returns the number of counts in each [edges[i], edges[i + 1]) bin
+        '''
+        ranks = [bisect.bisect_left(self.counts, edge) for edge in edges]
+        return [ranks[i + 1] - ranks[i] for i in xrange(len(ranks) - 1)]
+
+class CoListingMatrix:
+    '''
+    CoListingMatrix(users = [])
+    - A sparse, symmetric series x series matrix (M transposed times M over
+    the user/series incidence) counting how many users listed each pair of
+    series together. Only pairs that actually co-occur are stored, as
+    rows[a][b]; the diagonal is kept separately in listings[a].
+    '''
+    def __init__(self, users = []):
+        self.rows = {}
+        self.listings = {}
+        self.userCount = 0
+        if users:
+            self.addUsers(users)
+    
+    def addUsers(self, users, chunkSize = 10000):
+        '''
+        addUsers(self, users, chunkSize = 10000)
+        -counts the pairs of each chunk of users in a small local dict, then
+        merges it into rows, so the working set stays bounded by the chunk
+        '''
+        chunk = []
+        for user in users:
+            chunk.append(user)
+            if len(chunk) >= chunkSize:
+                self._addChunk(chunk)
+                chunk = []
+        if chunk:
+            self._addChunk(chunk)
+    
+    def _addChunk(self, users):
+        pairs = {}
+        for user in users:
+            shows = sorted(set(user[1:]))
+            self.userCount += 1
+            for i, a in enumerate(shows):
+                self.listings[a] = self.listings.get(a, 0) + 1
+                for b in shows[i + 1:]:
+                    pairs[(a, b)] = pairs.get((a, b), 0) + 1
+        for (a, b), count in pairs.iteritems():
+            row = self.rows.setdefault(a, {})
+            row[b] = row.get(b, 0) + count
+            row = self.rows.setdefault(b, {})
+            row[a] = row.get(a, 0) + count
+    
+    def add(self, user):
+        '''
+        add(self, user)
+        -adds the pairs of a single user
+        '''
+        self._addChunk([user])
+    
+    def remove(self, user):
+        '''
+        remove(self, user)
+        -removes the pairs of a user that was previously added
+        '''
+        shows = sorted(set(user[1:]))
+        self.userCount -= 1
+        for a in shows:
+            self.listings[a] -= 1
+            if self.listings[a] == 0:
+                del self.listings[a]
+            row = self.rows.get(a, {})
+            for b in shows:
+                if b != a:
+                    row[b] -= 1
+                    if row[b] == 0:
+                        del row[b]
+            if not row and a in self.rows:
+                del self.rows[a]
+    
+    def count(self, a, b):
+        '''
+        count(self, a, b)
+        -returns the number of users who listed both a and b
+        '''
+        if a == b:
+            return self.listings.get(a, 0)
+        return self.rows.get(a, {}).get(b, 0)
+    
+    def similarity(self, a, b, measure = "pmi"):
+        '''
+        similarity(self, a, b, measure = "pmi")
+        -returns the association of a and b. measure is one of "pmi"
+        (pointwise mutual information), "cosine", "jaccard" or "count"
+        '''
+        return self._score(self.count(a, b), self.listings.get(a, 0),
+                           self.listings.get(b, 0), measure)
+    
+    def _score(self, both, countA, countB, measure):
+        if measure == "count":
+            return both
+        if both == 0:
+            if measure == "pmi":
+                return float("-inf")
+            return 0.0
+        if measure == "pmi":
+            return math.log(float(both) * self.userCount / (countA * countB))
+        elif measure == "cosine":
+            return both / math.sqrt(countA * countB)
+        elif measure == "jaccard":
+            return float(both) / (countA + countB - both)
+        raise ValueError("unknown measure: " + str(measure))
+    
+    def neighbours(self, show, k = 10, measure = "pmi", minCount = 1):
+        '''
+        neighbours(self, show, k = 10, measure = "pmi", minCount = 1)
+        -returns the k series most associated with show, as (series,
+        similarity, times listed together), best first. Only show's own row
+        is scanned. Pairs listed together fewer than minCount times are
+        skipped
+        '''
+        countA = self.listings.get(show, 0)
+        scored = []
+        for b, both in self.rows.get(show, {}).iteritems():
+            if both >= minCount:
+                scored.append((self._score(both, countA, self.listings[b], measure), b, both))
+        best = heapq.nlargest(k, scored)
+        return [(b, score, both) for (score, b, both) in best]
+
+class MinHashIndex:
+    '''
+    MinHashIndex(numHashes = 144, bands = 48, seed = 0)
+    - Locality sensitive hashing of sets of series for nearest neighbour
+    search by jaccard similarity. Each set gets a MinHash signature of
+    numHashes values, cut into bands; sets sharing any whole band land in
+    the same bucket. A query only looks at the sets in its own buckets and
+    ranks those by their exact jaccard similarity, so its cost follows the
+    number of near matches rather than the number of users.
+    
+    A pair with similarity s shares a band with probability
+    1 - (1 - s^r)^bands, r being numHashes / bands. With the defaults
+    (r = 3), two lists of 9 shows are found about 94% of the time with 5
+    shows in common (s = 0.38), 68% with 4 and 32% with 3, while a list
+    sharing a single show is a candidate only about 1% of the time. Fewer
+    rows per band would find more of the weak matches, but would make
+    nearly every list that shares a popular show a candidate.
+    '''
+    def __init__(self, numHashes = 144, bands = 48, seed = 0):
+        if numHashes % bands != 0:
+            raise ValueError("numHashes must be a multiple of bands")
+        self.prime = (1 << 61) - 1
+        rng = random.Random(seed)
+        self.hashes = [(rng.randrange(1, self.prime), rng.randrange(self.prime))
+                       for i in xrange(numHashes)]
+        self.bands = bands
+        self.rows = numHashes / bands
+        self.buckets = [{} for i in xrange(bands)]
+        self.sets = {}
+        self.values = {}
+        self.nextId = 0
+    
+    def __len__(self):
+        return len(self.sets)
+    
+    def signature(self, shows):
+        '''
+        signature(self, shows)
+        -returns the MinHash signature of a set of shows
+        '''
+        ids = [zlib.crc32(show) & 0xffffffff for show in shows]
+        return [min([(a * x + b) % self.prime for x in ids])
+                for (a, b) in self.hashes]
+    
+    def _bandKeys(self, signature):
+        r = self.rows
+        return [tuple(signature[i * r:(i + 1) * r]) for i in xrange(self.bands)]
+    
+    def insert(self, shows, value):
+        '''
+        insert(self, shows, value)
+        -adds a list of shows along with its value (the show count), and
+        returns its id in the index
+        '''
+        shows = frozenset(shows)
+        if not shows:
+            return None
+        userId = self.nextId
+        self.nextId += 1
+        self.sets[userId] = shows
+        self.values[userId] = value
+        for band, key in zip(self.buckets, self._bandKeys(self.signature(shows))):
+            band.setdefault(key, []).append(userId)
+        return userId
+    
+    def remove(self, shows, value):
+        '''
+        remove(self, shows, value)
+        -removes one previously inserted list with the same shows and value
+        '''
+        shows = frozenset(shows)
+        keys = self._bandKeys(self.signature(shows))
+        for userId in self.buckets[0].get(keys[0], []):
+            if self.sets[userId] == shows and self.values[userId] == value:
+                break
+        else:
+            raise ValueError("list not in index")
+        for band, key in zip(self.buckets, keys):
+            band[key].remove(userId)
+            if not band[key]:
+                del band[key]
+        del self.sets[userId]
+        del self.values[userId]
+    
+    def candidates(self, shows):
+        '''
+        candidates(self, shows)
+        -returns the ids of every set sharing a band with shows
+        '''
+        found = set()
+        for band, key in zip(self.buckets, self._bandKeys(self.signature(shows))):
+            found.update(band.get(key, ()))
+        return found
+    
+    def query(self, shows, k = 5):
+        '''
+        query(self, shows, k = 5)
+        -returns up to k (jaccard similarity, value) pairs for the stored
+        sets most similar to shows, best first
+        '''
+        shows = frozenset(shows)
+        if not shows:
+            return []
+        scored = []
+        for userId in self.candidates(shows):
+            other = self.sets[userId]
+            both = len(shows & other)
+            if both:
+                similarity = float(both) / (len(shows) + len(other) - both)
+                scored.append((similarity, self.values[userId]))
+        return heapq.nlargest(k, scored)
+
+class BKTree:
+    '''
+    BKTree()
+    - A Burkhard-Keller tree of integer hashes under hamming distance. Each
+    child hangs off its parent by their distance, so by the triangle
+    inequality a search within d of a hash only has to descend into
+    children whose edge is within d of the parent's own distance.
+    '''
+    def __init__(self):
+        self.root = None
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def add(self, hashValue, name):
+        '''
+        add(self, hashValue, name)
+        -stores name under hashValue
+        '''
+        self.size += 1
+        if self.root is None:
+            self.root = [hashValue, [name], {}]
+            return
+        node = self.root
+        while True:
+            distance = hammingDistance(hashValue, node[0])
+            if distance == 0:
+                node[1].append(name)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [hashValue, [name], {}]
+                return
+            node = node[2][distance]
+    
+    def search(self, hashValue, maxDistance):
+        '''
+        search(self, hashValue, maxDistance)
+        -returns (distance, name) for every stored name within maxDistance
+        of hashValue, nearest first
+        '''
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hammingDistance(hashValue, node[0])
+            if distance <= maxDistance:
+                found.extend([(distance, name) for name in node[1]])
+            for edge, child in node[2].iteritems():
+                if distance - maxDistance <= edge <= distance + maxDistance:
+                    stack.append(child)
+        found.sort()
+        return found
+
+class CoverArtIndex:
+    '''
+    CoverArtIndex()
+    - Perceptual hashes of cover art keyed by canonical series name, held
+    in a BKTree so a tile can be matched to its nearest cover without
+    comparing it against every one. Save and load it with pickle like the
+    names database; only the (name, hash) pairs are stored and the tree is
+    rebuilt on load.
+    '''
+    def __init__(self, pairs = []):
+        self.tree = BKTree()
+        self.pairs = []
+        for name, hashValue in pairs:
+            self.addHash(name, hashValue)
+    
+    def __len__(self):
+        return len(self.tree)
+    
+    def addHash(self, name, hashValue):
+        '''
+        addHash(self, name, hashValue)
+        -adds a cover hash for the canonical series name
+        '''
+        self.tree.add(hashValue, name)
+        self.pairs.append((name, hashValue))
+    
+    def addImage(self, name, image):
+        '''
+        addImage(self, name, image)
+        -hashes a cover image (a filename or PIL image) and adds it
+        '''
+        self.addHash(name, dHash(openImage(image)))
+    
+    def addDirectory(self, directory):
+        '''
+        addDirectory(self, directory)
+        -adds every image in directory, using the url-unquoted filename
+        without its extension as the canonical name, so
+        Ghost_in_the_Shell%3A_S.A.C._2nd_GIG.jpg is filed under
+        Ghost_in_the_Shell:_S.A.C._2nd_GIG
+        '''
+        for filename in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(filename)
+            if extension.lower() in (".jpg", ".jpeg", ".png", ".gif", ".bmp"):
+                self.addImage(urllib.unquote(name), os.path.join(directory, filename))
+    
+    def match(self, hashValue, maxDistance = 10):
+        '''
+        match(self, hashValue, maxDistance = 10)
+        -returns the name of the nearest cover within maxDistance bits of
+        hashValue, or None
+        '''
+        found = self.tree.search(hashValue, maxDistance)
+        if found:
+            return found[0][1]
+        return None
+    
+    def save(self, indexFile):
+        '''
+        save(self, indexFile)
+        -pickles the (name, hash) pairs to indexFile
+        '''
+        output = open(indexFile, 'wb')
+        pickle.dump(self.pairs, output, pickle.HIGHEST_PROTOCOL)
+        output.close()
+
+def loadCoverIndex(indexFile):
+    '''
+    loadCoverIndex(indexFile)
+    -returns the CoverArtIndex pickled in indexFile
+    '''
+    pkl_file = open(indexFile, 'rb')
+    pairs = pickle.load(pkl_file)
+    pkl_file.close()
+    return CoverArtIndex(pairs)
+
+def openImage(image):
+    '''
+    openImage(image)
+    -returns image as a PIL image, opening it if it is a filename. PIL is
+    only needed for the image functions, so it is imported here
+    '''
+    from PIL import Image
+    if isinstance(image, basestring):
+        image = Image.open(image)
+    return image
+
+def hammingDistance(a, b):
+    '''
+    hammingDistance(a, b)
+    -returns the number of bits that differ between two integer hashes
+    '''
+    return bin(a ^ b).count("1")
+
+def dHash(image, size = 8):
+    '''
+    dHash(image, size = 8)
+    -returns the size * size bit difference hash of a PIL image: the image
+    is shrunk to greyscale (size + 1) x size and each bit records whether a
+    pixel is brighter than its right neighbour. Resizing, recompression and
+    small colour shifts only flip a few bits
+    '''
+    from PIL import Image
+    small = image.convert("L").resize((size + 1, size), Image.ANTIALIAS)
+    pixels = list(small.getdata())
+    result = 0
+    for row in xrange(size):
+        for col in xrange(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            result = (result << 1) | (left > right)
+    return result
+
+def gridTiles(image, rows = 3, cols = 3, margin = 0.02):
+    '''
+    gridTiles(image, rows = 3, cols = 3, margin = 0.02)
+    -splits a chart image into rows * cols tiles, left to right then top
+    to bottom. margin is the fraction trimmed off each side of a tile so
+    the grid lines and captions don't end up in the hash
+    '''
+    image = openImage(image)
+    width, height = image.size
+    tiles = []
+    for row in xrange(rows):
+        for col in xrange(cols):
+            left = width * col / float(cols)
+            top = height * row / float(rows)
+            right = width * (col + 1) / float(cols)
+            bottom = height * (row + 1) / float(rows)
+            dx = (right - left) * margin
+            dy = (bottom - top) * margin
+            tiles.append(image.crop((int(left + dx), int(top + dy),
+                                     int(right - dx), int(bottom - dy))))
+    return tiles
+
+def recognizeGrid(image, coverIndex, maxDistance = 10):
+    '''
+    recognizeGrid(image, coverIndex, maxDistance = 10)
+    -returns the canonical names of the nine tiles of a 3x3 chart, with
+    None for any tile that matches no cover
+    '''
+    return [coverIndex.match(dHash(tile), maxDistance)
+            for tile in gridTiles(image)]
+
+_bootstrapData = []
+
+def bootstrapSeries(counts, users, series, numberSeries, replicates = 1000,
+                    processes = 1, batchSize = None, seed = 0):
+    '''
+    bootstrapSeries(counts, users, series, numberSeries, replicates = 1000,
+                    processes = 1, batchSize = None, seed = 0)
+    -returns (weights, popularity), two replicates x numberSeries numpy
+    arrays of bootstrapped per series weights and popularity. counts holds
+    each user's show count and (users[i], series[i]) are the pairs of the
+    user/series incidence.
+    
+    A replicate draws every user's multiplicity at once from a multinomial,
+    then gets each series' resampled popularity and show count total with
+    one numpy.add.reduceat over the pairs sorted by series; nothing is
+    retrained in a python loop. batchSize replicates are done per pass (by
+    default as many as fit in about 8 million pair entries) and with
+    processes above 1 the batches are spread over a multiprocessing pool,
+    which needs this file loaded as a module (see ScoringPool). Each batch
+    has its own seed, so the result doesn't depend on processes.
+    A series nobody in a replicate listed gets that replicate's mean show
+    count, i.e. no evidence reads as an average anon, so a show listed once
+    gets a wide interval rather than a zero width one.
+    '''
+    import numpy
+    users = numpy.asarray(users, dtype = numpy.intp)
+    series = numpy.asarray(series, dtype = numpy.intp)
+    order = numpy.argsort(series, kind = "mergesort")
+    users = users[order]
+    series = series[order]
+    starts = numpy.searchsorted(series, numpy.arange(numberSeries))
+    if len(series) == 0 or numpy.any(numpy.bincount(series, minlength = numberSeries) == 0):
+        raise ValueError("every series needs at least one user")
+    if batchSize is None:
+        batchSize = max(1, min(replicates, 8000000 / len(users)))
+    jobs = []
+    done = 0
+    while done < replicates:
+        size = min(batchSize, replicates - done)
+        jobs.append((seed * 1000003 + len(jobs), size))
+        done += size
+    _bootstrapData[:] = [(numpy.asarray(counts, dtype = numpy.float64), users, starts)]
+    try:
+        if processes > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_bootstrapBatch, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_bootstrapBatch, jobs)
+    finally:
+        _bootstrapData[:] = []
+    weights = numpy.concatenate([result[0] for result in results])
+    popularity = numpy.concatenate([result[1] for result in results])
+    return weights, popularity
+
+def _bootstrapBatch(job):
+    # one batch of bootstrapSeries; the arrays come from _bootstrapData,
+    # which pool workers inherit when they fork
+    import numpy
+    seed, size = job
+    counts, users, starts = _bootstrapData[0]
+    n = len(counts)
+    rng = numpy.random.RandomState(seed % (2 ** 32))
+    draws = rng.multinomial(n, numpy.ones(n) / n, size = size)
+    picked = draws[:, users]
+    popularity = numpy.add.reduceat(picked, starts, axis = 1)
+    total = numpy.add.reduceat(picked * counts[users], starts, axis = 1)
+    mean = draws.dot(counts) / n
+    weights = numpy.where(popularity > 0,
+                          total / numpy.maximum(popularity, 1),
+                          mean[:, numpy.newaxis])
+    return weights.astype(numpy.float32), popularity.astype(numpy.int32)
+
+class QuantileSketch:
+    '''
+    QuantileSketch(k = 200, seed = None)
+    - A KLL quantile sketch: a mergeable summary of a stream of numbers in
+    O(k) memory. Values land in level 0; when a level is over its capacity
+    it is sorted and every other item, starting at a random one of the
+    first two, moves up a level where it stands for twice as many values.
+    Capacities shrink by 2/3 per level down from the top, so the sketch
+    never holds much more than 3k items. Rank error is about 1.7 / k; a series with
+    fewer than k values is kept exactly. Two sketches, say from different
+    chunks or processes, combine with merge.
+    '''
+    def __init__(self, k = 200, seed = None):
+        self.k = k
+        self.levels = [[]]
+        self.count = 0
+        self.rng = random.Random(seed)
+    
+    def __len__(self):
+        return self.count
+    
+    def _capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(math.ceil(self.k * (2.0 / 3) ** depth)))
+    
+    def add(self, value):
+        '''
+        add(self, value)
+        -adds one value
+        '''
+        self.levels[0].append(value)
+        self.count += 1
+        if len(self.levels[0]) >= self._capacity(0):
+            self._compress()
+    
+    def merge(self, other):
+        '''
+        merge(self, other)
+        -adds everything other has seen to this sketch
+        '''
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, level in enumerate(other.levels):
+            self.levels[h].extend(level)
+        self.count += other.count
+        self._compress()
+    
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+                items = sorted(self.levels[h])
+                if len(items) % 2:
+                    self.levels[h] = [items.pop()]
+                else:
+                    self.levels[h] = []
+                self.levels[h + 1].extend(items[self.rng.randint(0, 1)::2])
+            h += 1
+    
+    def weighted(self):
+        '''
+        weighted(self)
+        -returns the sorted (value, weight) items, whose weights add up to
+        count
+        '''
+        items = []
+        for h, level in enumerate(self.levels):
+            weight = 2 ** h
+            items.extend([(value, weight) for value in level])
+        items.sort()
+        return items
+    
+    def quantile(self, q):
+        '''
+        quantile(self, q)
+        -returns the estimated q quantile (0 to 1), interpolating between
+        neighbouring items, so the median of 100 and 500 is 300
+        '''
+        items = self.weighted()
+        if not items:
+            raise ValueError("empty sketch")
+        target = q * self.count
+        below = 0
+        previous = None
+        for value, weight in items:
+            centre = below + weight / 2.0
+            if target <= centre:
+                if previous is None:
+                    return value
+                fraction = (target - previous[1]) / (centre - previous[1])
+                return previous[0] + (value - previous[0]) * fraction
+            previous = (value, centre)
+            below += weight
+        return items[-1][0]
+    
+    def median(self):
+        '''
+        median(self)
+        -returns the estimated median
+        '''
+        return self.quantile(0.5)
+    
+    def trimmedMean(self, trim = 0.1):
+        '''
+        trimmedMean(self, trim = 0.1)
+        -returns the mean of the values ranked between trim and 1 - trim,
+        counting the part of an item's weight that falls inside
+        '''
+        low = trim * self.count
+        high = (1 - trim) * self.count
+        total = 0.0
+        weights = 0.0
+        below = 0
+        for value, weight in self.weighted():
+            inside = min(below + weight, high) - max(below, low)
+            if inside > 0:
+                total += value * inside
+                weights += inside
+            below += weight
+        if weights == 0:
+            return self.median()
+        return total / weights
+    
+    def winsorizedMean(self, trim = 0.1):
+        '''
+        winsorizedMean(self, trim = 0.1)
+        -returns the mean after the lowest and highest trim of the values
+        are replaced by the nearest value that is kept
+        '''
+        items = self.weighted()
+        cut = int(trim * self.count)
+        low = self._valueAtRank(items, cut)
+        high = self._valueAtRank(items, self.count - 1 - cut)
+        total = 0.0
+        for value, weight in items:
+            total += min(max(value, low), high) * weight
+        return total / self.count
+    
+    def _valueAtRank(self, items, rank):
+        # the value of the item covering 0 based rank among the weights
+        below = 0
+        for value, weight in items:
+            below += weight
+            if below > rank:
+                return value
+        return items[-1][0]
+    
+    def statistic(self, method, trim = 0.1):
+        '''
+        statistic(self, method, trim = 0.1)
+        -returns the "median", "trimmed" or "winsorized" mean
+        '''
+        if method == "median":
+            return self.median()
+        elif method == "trimmed":
+            return self.trimmedMean(trim)
+        elif method == "winsorized":
+            return self.winsorizedMean(trim)
+        raise ValueError("unknown method: " + str(method))
+
+def buildSeriesSketches(users, k = 200, chunkSize = 10000, seed = 0):
+    '''
+    buildSeriesSketches(users, k = 200, chunkSize = 10000, seed = 0)
+    -returns a dict of series to the QuantileSketch of the show counts of
+    the users listing it. Users are taken chunkSize at a time into fresh
+    sketches that are then merged in, the same way sketches built in
+    other processes are combined with mergeSeriesSketches. Every sketch
+    is seeded with seed, so the result is the same from run to run
+    '''
+    result = {}
+    chunk = {}
+    seen = 0
+    for user in users:
+        for show in set(user[1:]):
+            if show not in chunk:
+                chunk[show] = QuantileSketch(k, seed)
+            chunk[show].add(user[0])
+        seen += 1
+        if seen % chunkSize == 0:
+            mergeSeriesSketches(result, chunk)
+            chunk = {}
+    mergeSeriesSketches(result, chunk)
+    return result
+
+def mergeSeriesSketches(into, other):
+    '''
+    mergeSeriesSketches(into, other)
+    -merges a dict of series sketches into another, in place
+    '''
+    for show, sketch in other.iteritems():
+        if show in into:
+            into[show].merge(sketch)
+        else:
+            into[show] = sketch
+    return into
+
+def packStrings(strings):
+    '''
+    packStrings(strings)
+    -returns the bytes of a string table for MappedStrings: the count, the
+    count + 1 offsets of each string into the text, then the text
+    '''
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return (struct.pack("<Q", len(strings)) +
+            struct.pack("<%dQ" % len(offsets), *offsets) + "".join(strings))
+
+class MappedStrings:
+    '''
+    MappedStrings(buffer, offset)
+    - A read only view of a string table written by packStrings, at offset
+    in buffer (usually an mmap). Nothing is copied up front; a string is
+    only sliced out when it is asked for, so opening a table of any size is
+    O(1). If the strings were sorted, find is a binary search.
+    '''
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.count = struct.unpack_from("<Q", buffer, offset)[0]
+        self.offsets = offset + 8
+        self.text = self.offsets + 8 * (self.count + 1)
+        self.end = self.text + struct.unpack_from("<Q", buffer, self.offsets + 8 * self.count)[0]
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("string table index out of range")
+        start, end = struct.unpack_from("<QQ", self.buffer, self.offsets + 8 * i)
+        return self.buffer[self.text + start:self.text + end]
+    
+    def find(self, key):
+        '''
+        find(self, key)
+        -returns the index of key in a sorted table, or -1
+        '''
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self[low] == key:
+            return low
+        return -1
+
+imageMagic = "NFMIMG01"
+
+def writeModelImage(imageFile, seriesList, seriesWeights, popularityList,
+                    seriesDB):
+    '''
+    writeModelImage(imageFile, seriesList, seriesWeights, popularityList,
+                    seriesDB)
+    -writes a ModelImage file. The layout is the magic, five little endian
+    section offsets, the sorted series names (packStrings), their float64
+    weights, their int64 popularity, the sorted name conversion keys and
+    the int64 series number each one converts to (-1 for a series that is
+    not in the catalog). See writeSections
+    '''
+    order = sorted(xrange(len(seriesList)), key = lambda j: seriesList[j])
+    names = [seriesList[j] for j in order]
+    position = dict((name, i) for (i, name) in enumerate(names))
+    aliases = sorted(seriesDB)
+    sections = [packStrings(names),
+                struct.pack("<%dd" % len(order), *[seriesWeights[j] for j in order]),
+                struct.pack("<%dq" % len(order), *[popularityList[j] for j in order]),
+                packStrings(aliases),
+                struct.pack("<%dq" % len(aliases),
+                            *[position.get(seriesDB[alias], -1) for alias in aliases])]
+    writeSections(imageFile, imageMagic, sections)
+
+def writeSections(filename, magic, sections):
+    '''
+    writeSections(filename, magic, sections)
+    -writes magic, the little endian offset of each section, then the
+    sections themselves, each aligned to 8 bytes. The file is written
+    beside filename and renamed over it, so readers (and anyone who still
+    has the old file mapped) never see half a file
+    '''
+    offsets = []
+    offset = len(magic) + 8 * len(sections)
+    for section in sections:
+        offset += -offset % 8
+        offsets.append(offset)
+        offset += len(section)
+    output = open(filename + ".tmp", 'wb')
+    output.write(magic + struct.pack("<%dQ" % len(offsets), *offsets))
+    for section, offset in zip(sections, offsets):
+        output.write("\0" * (offset - output.tell()))
+        output.write(section)
+    output.close()
+    os.rename(filename + ".tmp", filename)
+
+class ModelImage:
+    '''
+    ModelImage(imageFile)
+    - A trained model opened straight from a file written by
+    NewFagMeter.writeImage. The file is mmap'd read only, so every process
+    that opens it shares the same pages of memory and opening it costs
+    nothing however big the catalog is. Titles are standardized through
+    the stored name conversions only (no searching), so a title that isn't
+    in them or the catalog is simply a miss.
+    '''
+    def __init__(self, imageFile):
+        data = open(imageFile, 'rb')
+        self.buffer = mmap.mmap(data.fileno(), 0, access = mmap.ACCESS_READ)
+        data.close()
+        if self.buffer[:len(imageMagic)] != imageMagic:
+            raise ValueError(imageFile + " is not a model image")
+        (names, self.weights, self.popularity, aliases,
+         self.targets) = struct.unpack_from("<5Q", self.buffer, len(imageMagic))
+        self.names = MappedStrings(self.buffer, names)
+        self.aliases = MappedStrings(self.buffer, aliases)
+    
+    def close(self):
+        '''
+        close(self)
+        -unmaps the file
+        '''
+        self.buffer.close()
+    
+    def numberShows(self):
+        '''
+        numberShows(self)
+        -returns the number of shows in the catalog
+        '''
+        return len(self.names)
+    
+    def seriesId(self, show, standardize = True):
+        '''
+        seriesId(self, show, standardize = True)
+        -returns the catalog number of show, or -1. With standardize the
+        name conversions are tried first
+        '''
+        if standardize:
+            i = self.aliases.find(show.lower())
+            if i != -1:
+                return struct.unpack_from("<q", self.buffer, self.targets + 8 * i)[0]
+        return self.names.find(show)
+    
+    def weight(self, i):
+        '''
+        weight(self, i)
+        -returns the weight of catalog number i
+        '''
+        return struct.unpack_from("<d", self.buffer, self.weights + 8 * i)[0]
+    
+    def getPopularity(self, i):
+        '''
+        getPopularity(self, i)
+        -returns the popularity of catalog number i
+        '''
+        return struct.unpack_from("<q", self.buffer, self.popularity + 8 * i)[0]
+    
+    def score(self, inputlist, standardize = True):
+        '''
+        score(self, inputlist, standardize = True)
+        -returns (predicted show count, average popularity, hits), where
+        the averages are None if no show hit
+        '''
+        weight = 0.0
+        pop = 0.0
+        hits = 0
+        for show in inputlist:
+            i = self.seriesId(show, standardize)
+            if i != -1:
+                weight += self.weight(i)
+                pop += self.getPopularity(i)
+                hits += 1
+        if hits == 0:
+            return None, None, 0
+        return weight / hits, pop / hits, hits
+    
+    def linearClassifyScore(self, inputlist, standardize = True):
+        '''
+        linearClassifyScore(self, inputlist, standardize = True)
+        - same as NewFagMeter.linearClassifyScore, None if nothing hit
+        '''
+        return self.score(inputlist, standardize)[0]
+    
+    def linearClassifyPop(self, inputlist, standardize = True):
+        '''
+        linearClassifyPop(self, inputlist, standardize = True)
+        - same as NewFagMeter.linearClassifyPop, None if nothing hit
+        '''
+        return self.score(inputlist, standardize)[1]
+
+_workerImage = []
+
+def _attachImage(imageFile):
+    # ScoringPool worker initializer: map the image once per process
+    _workerImage[:] = [ModelImage(imageFile)]
+
+def _scoreChunk(job):
+    inputlists, standardize = job
+    image = _workerImage[0]
+    return [image.score(inputlist, standardize) for inputlist in inputlists]
+
+class ScoringPool:
+    '''
+    ScoringPool(imageFile, processes = None, chunkSize = 64)
+    - A pool of worker processes that each mmap the same ModelImage, so
+    the model is in memory once however many workers there are, and none
+    of them parses or trains anything. score() splits a batch of input
+    lists into chunks of chunkSize and hands them out to the workers.
+    processes defaults to the number of cores.
+    
+    The workers are sent _scoreChunk by its module's name, so outside of
+    the newfag1.5.py script itself the file has to be loaded as a module
+    (its name has a dot in it, so it can't simply be imported):
+    
+        import imp
+        newfag = imp.load_source("newfag", "newfag1.5.py")
+        pool = newfag.ScoringPool("model.img")
+    
+    Running the source into a plain dict namespace, as regression.py does,
+    is fine for everything else but not for a pool.
+    '''
+    def __init__(self, imageFile, processes = None, chunkSize = 64):
+        import multiprocessing
+        self.chunkSize = chunkSize
+        self.pool = multiprocessing.Pool(processes, _attachImage, (imageFile,))
+    
+    def score(self, inputlists, standardize = True):
+        '''
+        score(self, inputlists, standardize = True)
+        -returns ModelImage.score for each input list, in order
+        '''
+        jobs = [(inputlists[i:i + self.chunkSize], standardize)
+                for i in xrange(0, len(inputlists), self.chunkSize)]
+        result = []
+        for chunk in self.pool.map(_scoreChunk, jobs):
+            result.extend(chunk)
+        return result
+    
+    def linearClassifyScore(self, inputlists, standardize = True):
+        '''
+        linearClassifyScore(self, inputlists, standardize = True)
+        -returns the predicted show count for each input list
+        '''
+        return [result[0] for result in self.score(inputlists, standardize)]
+    
+    def close(self):
+        '''
+        close(self)
+        -shuts the workers down
+        '''
+        self.pool.close()
+        self.pool.join()
+
+def shardOf(show, numberShards):
+    '''
+    shardOf(show, numberShards)
+    -returns the shard a series belongs to, by a hash of its name that is
+    the same in every process
+    '''
+    return (zlib.crc32(show) & 0xffffffff) % numberShards
+
+def partitionModel(model, numberShards):
+    '''
+    partitionModel(model, numberShards)
+    -splits a trained model into numberShards shard states, one dict each.
+    A shard holds the weight and popularity of its own series and their
+    rows of the co-listing matrix, along with the listing counts of every
+    series in those rows, so it can score its neighbours on its own
+    '''
+    coListing = model.coListing
+    if coListing is None:
+        coListing = CoListingMatrix(model.M)
+    states = [{"series": {}, "rows": {}, "listings": {},
+               "userCount": coListing.userCount} for i in xrange(numberShards)]
+    for j, show in enumerate(model.seriesList):
+        state = states[shardOf(show, numberShards)]
+        state["series"][show] = (model.seriesWeights[j], model.popularityList[j])
+        row = coListing.rows.get(show, {})
+        state["rows"][show] = dict(row)
+        state["listings"][show] = coListing.listings.get(show, 0)
+        for other in row:
+            state["listings"][other] = coListing.listings[other]
+    return states
+
+def writeShards(model, numberShards, prefix):
+    '''
+    writeShards(model, numberShards, prefix)
+    -pickles the shard states of model to prefix0.pkl, prefix1.pkl ... for
+    serveShard on other machines, and returns the filenames
+    '''
+    filenames = []
+    for i, state in enumerate(partitionModel(model, numberShards)):
+        filename = prefix + str(i) + ".pkl"
+        output = open(filename, 'wb')
+        pickle.dump(state, output, pickle.HIGHEST_PROTOCOL)
+        output.close()
+        filenames.append(filename)
+    return filenames
+
+def serveShard(shardFile, host = "127.0.0.1", port = 0):
+    '''
+    serveShard(shardFile, host = "127.0.0.1", port = 0)
+    -loads a shard written by writeShards and serves it until stopped
+    '''
+    pkl_file = open(shardFile, 'rb')
+    state = pickle.load(pkl_file)
+    pkl_file.close()
+    server = ShardServer(state, host, port)
+    print "serving", shardFile, "on", server.address
+    server.serveForever()
+
+def _jsonStr(value):
+    # json gives back unicode; the model's names are utf-8 strs
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+class ShardServer:
+    '''
+    ShardServer(state, host = "127.0.0.1", port = 0)
+    - Serves one shard state from partitionModel over TCP. Requests and
+    replies are single lines of JSON; each connection gets its own thread
+    and can send any number of requests. The ops are
+    
+         lookup
+            - {"shows": [...]}, replies {"found": {show: [weight,
+            popularity]}} for the shows this shard has
+            
+         top
+            - {"scale": "popularity" or "powerLevel", "k": k or null,
+            "minPopularity": m}, replies {"items": [[value, show], ...]},
+            this shard's k best, best first
+            
+         neighbours
+            - {"show", "k", "measure", "minCount"}, replies {"items":
+            [[show, similarity, count], ...]} as CoListingMatrix.neighbours
+            
+         size
+            - replies {"series": how many series this shard has}
+            
+         stop
+            - shuts the server down
+    
+    port 0 picks a free port; the one chosen is in address.
+    '''
+    def __init__(self, state, host = "127.0.0.1", port = 0):
+        self.state = state
+        self.coListing = CoListingMatrix()
+        self.coListing.rows = state["rows"]
+        self.coListing.listings = state["listings"]
+        self.coListing.userCount = state["userCount"]
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.address = self.listener.getsockname()
+        self.running = True
+    
+    def serveForever(self):
+        '''
+        serveForever(self)
+        -accepts connections until a stop request comes in
+        '''
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except socket.error:
+                if not self.running:
+                    break
+                raise
+            thread = threading.Thread(target = self._serve, args = (connection,))
+            thread.daemon = True
+            thread.start()
+        self.listener.close()
+    
+    def _serve(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = connection.makefile('rb')
+        try:
+            for line in stream:
+                request = json.loads(line)
+                reply = self.handle(request)
+                connection.sendall(json.dumps(reply) + "\n")
+                if request.get("op") == "stop":
+                    self.running = False
+                    # shutdown, unlike close, wakes the accept in serveForever
+                    self.listener.shutdown(socket.SHUT_RDWR)
+                    break
+        except socket.error:
+            pass
+        stream.close()
+        connection.close()
+    
+    def handle(self, request):
+        '''
+        handle(self, request)
+        -returns the reply to one decoded request
+        '''
+        op = request.get("op")
+        series = self.state["series"]
+        if op == "lookup":
+            found = {}
+            for show in request["shows"]:
+                show = _jsonStr(show)
+                if show in series:
+                    found[show] = series[show]
+            return {"found": found}
+        elif op == "top":
+            minPopularity = request.get("minPopularity", 0)
+            if request["scale"] == "popularity":
+                column = 1
+            else:
+                column = 0
+            candidates = [(values[column], show) for (show, values) in series.iteritems()
+                          if values[1] >= minPopularity]
+            k = request.get("k")
+            if k is None:
+                items = sorted(candidates, reverse = True)
+            else:
+                items = heapq.nlargest(k, candidates)
+            return {"items": items}
+        elif op == "neighbours":
+            return {"items": self.coListing.neighbours(_jsonStr(request["show"]),
+                                                       request.get("k", 10),
+                                                       request.get("measure", "pmi"),
+                                                       request.get("minCount", 1))}
+        elif op == "size":
+            return {"series": len(series)}
+        elif op == "stop":
+            return {"stopped": True}
+        return {"error": "unknown op: " + str(op)}
+
+def _runLocalShard(state, addresses, i):
+    server = ShardServer(state)
+    addresses.put((i, server.address))
+    server.serveForever()
+
+def startLocalShards(model, numberShards):
+    '''
+    startLocalShards(model, numberShards)
+    -partitions model and serves each shard from its own local process.
+    Returns (processes, addresses) for ShardedModel. Load this file as a
+    module first, as for ScoringPool
+    '''
+    import multiprocessing
+    addresses = multiprocessing.Queue()
+    processes = []
+    for i, state in enumerate(partitionModel(model, numberShards)):
+        process = multiprocessing.Process(target = _runLocalShard,
+                                          args = (state, addresses, i))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    found = dict(addresses.get(timeout = 30) for i in xrange(numberShards))
+    return processes, [found[i] for i in xrange(numberShards)]
+
+class ShardedModel:
+    '''
+    ShardedModel(addresses, dbFile = None, database = None, resolver = None,
+                 binaryThreshold = 50)
+    - The coordinator for a model split over shard servers, one per
+    address (in shard order). Titles are standardized here with the names
+    database, then every query is scattered: the request for each shard
+    is sent to all of them before any reply is read, so the shards work at
+    the same time, and the replies are merged. Rank queries ask every shard
+    for its own top stop entries and merge those, which is enough for the
+    global top stop.
+    '''
+    def __init__(self, addresses, dbFile = None, database = None, resolver = None,
+                 binaryThreshold = 50):
+        self.dbFile = dbFile
+        self.database = database
+        self.resolver = resolver
+        self.binaryThreshold = binaryThreshold
+        self.connections = []
+        for address in addresses:
+            connection = socket.create_connection(tuple(address))
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.append((connection, connection.makefile('rb')))
+    
+    def _scatter(self, requests):
+        # requests maps shard number to request; returns shard to reply
+        for i, request in requests.iteritems():
+            self.connections[i][0].sendall(json.dumps(request) + "\n")
+        replies = {}
+        for i in requests:
+            line = self.connections[i][1].readline()
+            if not line:
+                raise socket.error("shard " + str(i) + " closed the connection")
+            replies[i] = json.loads(line)
+        return replies
+    
+    def _everyShard(self, request):
+        return self._scatter(dict((i, request) for i in xrange(len(self.connections))))
+    
+    def _standardize(self, inputlist, standardize):
+        if standardize and self.database is not None:
+            return [parseTitle(show, self.dbFile, self.database, self.resolver)
+                    for show in inputlist]
+        return list(inputlist)
+    
+    def lookup(self, shows):
+        '''
+        lookup(self, shows)
+        -returns a dict of each known show to (weight, popularity)
+        '''
+        requests = {}
+        for show in shows:
+            i = shardOf(show, len(self.connections))
+            requests.setdefault(i, {"op": "lookup", "shows": []})["shows"].append(show)
+        found = {}
+        for reply in self._scatter(requests).itervalues():
+            for show, values in reply["found"].iteritems():
+                found[_jsonStr(show)] = tuple(values)
+        return found
+    
+    def score(self, inputlist, standardize = True):
+        '''
+        score(self, inputlist, standardize = True)
+        -returns (predicted show count, average popularity, hits), the
+        averages None if no show is known
+        '''
+        shows = self._standardize(inputlist, standardize)
+        found = self.lookup(set(shows))
+        weight = 0.0
+        pop = 0.0
+        hits = 0
+        for show in shows:
+            if show in found:
+                weight += found[show][0]
+                pop += found[show][1]
+                hits += 1
+        if hits == 0:
+            return None, None, 0
+        return weight / hits, pop / hits, hits
+    
+    def linearClassifyScore(self, inputlist, standardize = True):
+        '''
+        linearClassifyScore(self, inputlist, standardize = True)
+        - same as NewFagMeter.linearClassifyScore, None if nothing hit
+        '''
+        return self.score(inputlist, standardize)[0]
+    
+    def binaryClassifyScore(self, inputlist, standardize = True):
+        '''
+        binaryClassifyScore(self, inputlist, standardize = True)
+        - returns 1 if linearClassifyScore() is >= binaryThreshold
+        '''
+        if self.linearClassifyScore(inputlist, standardize) >= self.binaryThreshold:
+            return 1
+        else:
+            return -1
+    
+    def linearClassifyPop(self, inputlist, standardize = True):
+        '''
+        linearClassifyPop(self, inputlist, standardize = True)
+        - same as NewFagMeter.linearClassifyPop, None if nothing hit
+        '''
+        return self.score(inputlist, standardize)[1]
+    
+    def _ranked(self, scale, start, stop, minPopularity):
+        replies = self._everyShard({"op": "top", "scale": scale, "k": stop,
+                                    "minPopularity": minPopularity})
+        items = []
+        for reply in replies.itervalues():
+            items.extend([(value, _jsonStr(show)) for (value, show) in reply["items"]])
+        if stop is None:
+            items.sort(reverse = True)
+        else:
+            items = heapq.nlargest(stop, items)
+        for rank in xrange(max(start, 1), len(items) + 1):
+            value, show = items[rank - 1]
+            yield rank, show, value
+    
+    def rankedPopularity(self, start = 1, stop = None):
+        '''
+        rankedPopularity(self, start = 1, stop = None)
+        -yields (rank, show, popularity) across all shards, as
+        NewFagMeter.rankedPopularity
+        '''
+        return self._ranked("popularity", start, stop, 0)
+    
+    def topPopular(self, k):
+        '''
+        topPopular(self, k)
+        -returns a list of the k most popular (rank, show, popularity)
+        '''
+        return list(self.rankedPopularity(1, k))
+    
+    def rankedPowerLevel(self, start = 1, stop = None, minPopularity = 0):
+        '''
+        rankedPowerLevel(self, start = 1, stop = None, minPopularity = 0)
+        -yields (rank, show, power level) across all shards, as
+        NewFagMeter.rankedPowerLevel
+        '''
+        return self._ranked("powerLevel", start, stop, minPopularity)
+    
+    def topPowerLevel(self, k, minPopularity = 0):
+        '''
+        topPowerLevel(self, k, minPopularity = 0)
+        -returns a list of the k most oldfag (rank, show, power level)
+        '''
+        return list(self.rankedPowerLevel(1, k, minPopularity))
+    
+    def alsoListed(self, show, k = 10, measure = "pmi", minCount = 1,
+                   standardize = True):
+        '''
+        alsoListed(self, show, k = 10, measure = "pmi", minCount = 1,
+                   standardize = True)
+        -as NewFagMeter.alsoListed, answered by the shard that owns show
+        '''
+        show = self._standardize([show], standardize)[0]
+        i = shardOf(show, len(self.connections))
+        reply = self._scatter({i: {"op": "neighbours", "show": show, "k": k,
+                                   "measure": measure, "minCount": minCount}})[i]
+        return [(_jsonStr(other), similarity, count)
+                for (other, similarity, count) in reply["items"]]
+    
+    def numberShows(self):
+        '''
+        numberShows(self)
+        -returns the number of shows over all shards
+        '''
+        return sum(reply["series"] for reply in self._everyShard({"op": "size"}).itervalues())
+    
+    def close(self, stopShards = False):
+        '''
+        close(self, stopShards = False)
+        -closes the connections, first telling the shards to stop if
+        stopShards is set
+        '''
+        if stopShards:
+            self._everyShard({"op": "stop"})
+        for connection, stream in self.connections:
+            stream.close()
+            connection.close()
+        self.connections = []
+
+def selectKth(values, k):
+    '''
+    selectKth(values, k)
+    -returns the k'th smallest (from 0) of values in expected O(n), without
+    sorting. Meant for one-off order statistics where a ShowCountStats
+    isn't worth building
+    '''
+    values = list(values)
+    if not 0 <= k < len(values):
+        raise IndexError("k out of range")
+    while True:
+        pivot = values[random.randrange(len(values))]
+        lower = [v for v in values if v < pivot]
+        if k < len(lower):
+            values = lower
+            continue
+        equal = values.count(pivot)
+        if k < len(lower) + equal:
+            return pivot
+        k -= len(lower) + equal
+        values = [v for v in values if v > pivot]
+
+def parseData(txtfile, dbFile, database, resolver = None):
+    '''
+    parseData(txtfile, dbFile, database, resolver = None)
+    - The textfile is a list of anon's data in the form:
+    power level
+    show 1
+    show 2
+    ...
+    show 9
+    power level
+    show 1
+    ...
+    -the dbFile is a pickled name conversion dictionary
+    -the database is the txtfile with all the names parsed into standard form
+    and in a list
+    -the resolver is passed on to parseTitle
+    '''
+    
+    data = open(txtfile, 'r')
+    result = parseLines(data, dbFile, database, resolver)
+    data.close()
+    
+    return result        
+
+def parseLines(lines, dbFile, database, resolver = None, result = None):
+    '''
+    parseLines(lines, dbFile, database, resolver = None, result = None)
+    -parses lines in the parseData format, starting at a show count line,
+    and returns the list of data points. New data points are appended to
+    result if it is given, and checked against it for duplicates. Names
+    looked up along the way are written to dbFile once, at the end
+    '''
+    if result is None:
+        result = []
+    known = len(database)
+    i = -1
+    try:
+        for line in lines:
+            i += 1
+            if i % 10 == 0:
+                try:
+                    dataPoint = [int(line[:-1])] # the number of shows
+                except:
+                    sys.stderr.write("input file not valid at line " + str(i))
+                    sys.exit(1)
+            elif i % 10 == 9:
+                if dataPoint in result:
+                    sys.stderr.write("duplicate detected at line " + str(i))
+                    sys.exit(1)               
+                result.append(dataPoint)
+            else:
+                title = parseTitle(line[:-1], dbFile, database, resolver, False)
+                #print "input: " + line[:-1]
+                #print "output: " + title
+                if title != "Unknown":
+                    dataPoint.append(title)
+    finally:
+        if len(database) != known:
+            saveDB(database, dbFile)
+    
+    return result
+
+def parseTitle(title, dbFile, database, resolver = None, save = True):
+    '''
+    parseTitle(title, dbFile, database, resolver = None, save = True)
+    -returns the standardized version of title. If a resolver is given it
+    is called with the title instead of searching google, and should return
+    the standardized name or None if it doesn't know the title. Titles no
+    one knows come back as "Unknown" and aren't saved; parseData and
+    addUser leave them out of the records, so "Unknown" never becomes a
+    series. A new name is added to database and, unless save is False,
+    written to dbFile straight away; callers resolving many titles pass
+    False and call saveDB once when they are done
+    '''
+    title = title.lower()
+    
+    if title in database:
+        #print "already found :"
+        return database[title]
+    
+    if resolver is not None:
+        seriesName = resolver(title)
+        if seriesName is None:
+            return "Unknown"
+        database[title] = seriesName
+        if save:
+            saveDB(database, dbFile)
+        return seriesName
+    
+    #print "querying google"
+    seriesName = defaultResolver()(title)
+    if seriesName is None:
+        #print "Error, series unknown"
+        #print title
+        return "Unknown"
+        
+    #update database and dbFile
+    database[title] = seriesName
+    if save:
+        saveDB(database, dbFile)
+        
+    return seriesName
+
+class TitleIndex:
+    '''
+    TitleIndex(titleFile = None)
+    - An offline resolver built from a local list of Wikipedia titles, such
+    as an all-titles-in-ns0 dump. Titles are kept as two parallel sorted
+    arrays, normalized keys and canonical names, so a lookup is a binary
+    search and no dict of the whole dump is ever built. The file is read
+    one line at a time (gzipped files too) and sorted in chunks through
+    temporary files (see load), and each line is one of
+    
+          Title                      an article
+          namespace<tab>Title        an all-titles dump line, only
+                                     namespace 0 is kept
+          Alias<tab>Target           a redirect from Alias to Target
+    
+    A TitleIndex can be passed anywhere a resolver is taken.
+    '''
+    qualifiers = [" (anime)", " (manga)", " (tv series)", " (film)"]
+    
+    def __init__(self, titleFile = None, maxPrefixScan = 200):
+        self.keys = []
+        self.titles = []
+        self.redirects = 0
+        self.maxPrefixScan = maxPrefixScan
+        if titleFile is not None:
+            self.load(titleFile)
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def __call__(self, title):
+        return self.resolve(title)
+    
+    def load(self, titleFile, chunkSize = 500000):
+        '''
+        load(self, titleFile, chunkSize = 500000)
+        -streams titleFile into the index, merging it with anything already
+        loaded. Every chunkSize entries are sorted and written to a
+        temporary file, and the chunks are merged into the index at the end,
+        so apart from the index itself only one chunk is held in memory
+        '''
+        if titleFile.endswith(".gz"):
+            data = gzip.open(titleFile, 'rb')
+        else:
+            data = open(titleFile, 'r')
+        chunks = []
+        entries = []
+        try:
+            for line in data:
+                entry = self._entry(line)
+                if entry is None:
+                    continue
+                entries.append(entry)
+                if len(entries) >= chunkSize:
+                    chunks.append(self._spill(entries))
+                    entries = []
+            entries.sort()
+            streams = [zip(self.keys, [0] * len(self.keys), self.titles), entries]
+            streams.extend([self._chunkEntries(chunk) for chunk in chunks])
+            keys = []
+            titles = []
+            redirects = 0
+            for key, isRedirect, title in heapq.merge(*streams):
+                if keys and keys[-1] == key:
+                    continue
+                keys.append(key)
+                titles.append(intern(title))
+                redirects += isRedirect
+        finally:
+            data.close()
+            for chunk in chunks:
+                chunk.close()
+        self.keys = keys
+        self.titles = titles
+        self.redirects = redirects
+    
+    def _entry(self, line):
+        # (normalized key, 1 if a redirect, canonical name) or None
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) == 1:
+            if fields[0] == "page_title" or not fields[0]:
+                return None
+            return (normalizeTitle(fields[0]), 0, fields[0].replace(" ", "_"))
+        if fields[0].isdigit():
+            if fields[0] == "0":
+                return (normalizeTitle(fields[1]), 0, fields[1].replace(" ", "_"))
+            return None
+        return (normalizeTitle(fields[0]), 1, fields[1].replace(" ", "_"))
+    
+    def _spill(self, entries):
+        # sorts entries into a temporary file of key<tab>flag<tab>name lines
+        entries.sort()
+        chunk = tempfile.TemporaryFile()
+        for key, isRedirect, title in entries:
+            chunk.write("%s\t%d\t%s\n" % (key, isRedirect, title))
+        chunk.seek(0)
+        return chunk
+    
+    def _chunkEntries(self, chunk):
+        for line in chunk:
+            key, isRedirect, title = line.rstrip("\n").split("\t")
+            yield key, int(isRedirect), title
+    
+    def exact(self, title):
+        '''
+        exact(self, title)
+        -returns the canonical name stored under the normalized title, which
+        is the redirect target for redirects, or None
+        '''
+        key = normalizeTitle(title)
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.titles[i]
+        return None
+    
+    def prefix(self, title):
+        '''
+        prefix(self, title)
+        -returns the canonical name of the shortest title starting with the
+        normalized title, or None. A disambiguated form like "shiki (novel
+        series)" is preferred over a longer word like "shikimori"
+        '''
+        key = normalizeTitle(title)
+        i = bisect.bisect_left(self.keys, key)
+        best = None
+        for j in xrange(i, min(i + self.maxPrefixScan, len(self.keys))):
+            if not self.keys[j].startswith(key):
+                break
+            rank = (not self.keys[j].startswith(key + " ("), len(self.keys[j]))
+            if best is None or rank < best[0]:
+                best = (rank, j)
+        if best is None:
+            return None
+        return self.titles[best[1]]
+    
+    def lookup(self, title):
+        '''
+        lookup(self, title)
+        -returns (canonical name, how it matched) or (None, None). The anime
+        and manga qualified forms of the title are tried before the bare
+        title, then the first prefix match
+        '''
+        for qualifier in self.qualifiers:
+            name = self.exact(title + qualifier)
+            if name is not None:
+                return name, "qualified"
+        name = self.exact(title)
+        if name is not None:
+            return name, "exact"
+        name = self.prefix(title)
+        if name is not None:
+            return name, "prefix"
+        return None, None
+    
+    def resolve(self, title):
+        '''
+        resolve(self, title)
+        -returns the canonical name for title, or None
+        '''
+        return self.lookup(title)[0]
+
+aliasStopWords = set(["the", "of", "no", "an", "and", "to", "in", "on", "wo", "ga",
+                      "wa", "tv", "anime", "manga", "series", "film", "high",
+                      "school", "legend", "story", "season", "movie", "ova"])
+
+def titleTokens(title):
+    '''
+    titleTokens(title)
+    -returns the set of words in a normalized title, without punctuation,
+    single letters (the "c" of "S.A.C.") and words too common to tell
+    titles apart
+    '''
+    words = "".join([c if c.isalnum() else " " for c in normalizeTitle(title)]).split()
+    return set(word for word in words if len(word) > 1 and word not in aliasStopWords)
+
+class AliasClusters:
+    '''
+    AliasClusters(priority = None)
+    - A union-find of series names, for names that are really one work.
+    find compresses paths as it goes and merges join the smaller cluster
+    under the larger, so canonical is close to O(1) per lookup. Each
+    cluster is named after its member with the highest priority (a dict of
+    name to number, such as popularity), ties going to the larger name.
+    Every merge is numbered and kept in merges, so any one of them can be
+    reverted, which rebuilds the forest from the merges that are left.
+    '''
+    def __init__(self, priority = None):
+        self.priority = priority or {}
+        self.merges = {}
+        self.nextMerge = 0
+        self._reset()
+    
+    def _reset(self):
+        self.parent = {}
+        self.size = {}
+        self.label = {}
+    
+    def find(self, name):
+        '''
+        find(self, name)
+        -returns the root of name's cluster
+        '''
+        parent = self.parent
+        if name not in parent:
+            return name
+        root = name
+        while parent[root] != root:
+            root = parent[root]
+        while parent[name] != root:
+            parent[name], name = root, parent[name]
+        return root
+    
+    def canonical(self, name):
+        '''
+        canonical(self, name)
+        -returns the name of name's cluster, name itself if it was never
+        merged
+        '''
+        if name not in self.parent:
+            return name
+        return self.label[self.find(name)]
+    
+    def _union(self, a, b):
+        for name in (a, b):
+            if name not in self.parent:
+                self.parent[name] = name
+                self.size[name] = 1
+                self.label[name] = name
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size.pop(b)
+        labels = (self.label[a], self.label.pop(b))
+        self.label[a] = max(labels, key = lambda name: (self.priority.get(name, 0), name))
+    
+    def merge(self, a, b):
+        '''
+        merge(self, a, b)
+        -puts a and b in one cluster and returns the number of the merge,
+        for revert
+        '''
+        merge = self.nextMerge
+        self.nextMerge += 1
+        self.merges[merge] = (a, b)
+        self._union(a, b)
+        return merge
+    
+    def revert(self, merge):
+        '''
+        revert(self, merge)
+        -undoes the merge numbered merge, keeping every other one
+        '''
+        del self.merges[merge]
+        self._reset()
+        for number in sorted(self.merges):
+            self._union(*self.merges[number])
+    
+    def members(self, name):
+        '''
+        members(self, name)
+        -returns the sorted names in name's cluster
+        '''
+        root = self.find(name)
+        if name not in self.parent:
+            return [name]
+        return sorted(other for other in self.parent if self.find(other) == root)
+    
+    def clusters(self):
+        '''
+        clusters(self)
+        -returns a dict of each cluster's name to its sorted members
+        '''
+        result = {}
+        for name in self.parent:
+            result.setdefault(self.label[self.find(name)], []).append(name)
+        for members in result.itervalues():
+            members.sort()
+        return result
+
+def _rowCosine(coListing, a, b):
+    # cosine of the co-listing rows of a and b, leaving out the pair itself
+    rowA = coListing.rows.get(a, {})
+    rowB = coListing.rows.get(b, {})
+    if len(rowA) > len(rowB):
+        rowA, rowB = rowB, rowA
+    dot = sum(count * rowB[c] for (c, count) in rowA.iteritems()
+              if c in rowB and c != a and c != b)
+    normA = math.sqrt(sum(count * count for (c, count) in coListing.rows.get(a, {}).iteritems()
+                          if c != b))
+    normB = math.sqrt(sum(count * count for (c, count) in coListing.rows.get(b, {}).iteritems()
+                          if c != a))
+    if normA == 0 or normB == 0:
+        return 0.0
+    return dot / (normA * normB)
+
+def proposeAliasMerges(database, coListing = None, redirects = None,
+                       minScore = 0.8, maxTokenShare = 20, shrinkage = 10,
+                       subsetScore = 0.5):
+    '''
+    proposeAliasMerges(database, coListing = None, redirects = None,
+                       minScore = 0.8, maxTokenShare = 20, shrinkage = 10,
+                       subsetScore = 0.5)
+    -returns the pairs of standardized names in database (and coListing)
+    that look like one work, as a list of (score, a, b, evidence) best
+    first. The evidence is a dict of
+    
+         name
+            - the largest share of the words of the shorter title, among
+            every title that converts to a against every one that converts
+            to b, needing two shared words unless the titles are equal. A
+            title whose words are all in a longer one, like "Lain" in
+            "Serial Experiments Lain" (or "Spice" in "Spice and Wolf"),
+            scores at most subsetScore, so by default it takes a shared
+            redirect or strong co-listing to propose it
+         redirect
+            - whether redirects (a resolver, such as a TitleIndex, asked
+            for each name) sends both names to the same page
+         coListing
+            - the cosine similarity of their rows of coListing, how alike
+            the rest of their lists are, shrunk by n / (n + shrinkage)
+            where n is the number of lists the rarer of the two is on, so
+            two shows listed once each don't look alike by chance
+    
+    and the score is name, plus 1 for a shared redirect, plus half of
+    coListing. Only pairs sharing a word used by at most maxTokenShare
+    names, or a redirect target, are compared
+    '''
+    titles = {}
+    for title, name in database.iteritems():
+        if name != "Unknown":
+            titles.setdefault(name, [name]).append(title)
+    if coListing is not None:
+        for name in coListing.listings:
+            titles.setdefault(name, [name])
+    tokens = dict((name, [tokenSet for tokenSet in map(titleTokens, aliases) if tokenSet])
+                  for (name, aliases) in titles.iteritems())
+    byToken = {}
+    for name, tokenSets in tokens.iteritems():
+        for word in set().union(*tokenSets) if tokenSets else ():
+            byToken.setdefault(word, []).append(name)
+    candidates = set()
+    for names in byToken.itervalues():
+        if len(names) <= maxTokenShare:
+            names = sorted(names)
+            for i in xrange(len(names)):
+                for j in xrange(i + 1, len(names)):
+                    candidates.add((names[i], names[j]))
+    targets = {}
+    if redirects is not None:
+        for name in titles:
+            target = redirects(name.replace("_", " "))
+            if target is not None:
+                targets[name] = target
+        byTarget = {}
+        for name, target in targets.iteritems():
+            byTarget.setdefault(target, []).append(name)
+        for names in byTarget.itervalues():
+            names = sorted(names)
+            for i in xrange(len(names)):
+                for j in xrange(i + 1, len(names)):
+                    candidates.add((names[i], names[j]))
+    proposals = []
+    for a, b in candidates:
+        nameScore = 0.0
+        for x in tokens[a]:
+            for y in tokens[b]:
+                shared = len(x & y)
+                if x == y:
+                    nameScore = 1.0
+                elif x < y or y < x:
+                    nameScore = max(nameScore, subsetScore)
+                elif shared >= 2:
+                    nameScore = max(nameScore, shared / float(min(len(x), len(y))))
+        redirect = a in targets and targets.get(b) == targets[a]
+        cosine = 0.0
+        if coListing is not None:
+            support = min(coListing.listings.get(a, 0), coListing.listings.get(b, 0))
+            if support:
+                cosine = _rowCosine(coListing, a, b) * support / float(support + shrinkage)
+        score = nameScore + redirect + 0.5 * cosine
+        if score >= minScore:
+            proposals.append((score, a, b, {"name": nameScore, "redirect": redirect,
+                                            "coListing": cosine}))
+    proposals.sort(key = lambda proposal: (-proposal[0], proposal[1], proposal[2]))
+    return proposals
+
+def normalizeTitle(title):
+    '''
+    normalizeTitle(title)
+    -lower cases a title, treats underscores as spaces and collapses runs
+    of whitespace, so "Serial_Experiments_Lain" and "serial  experiments
+    lain" compare equal
+    '''
+    return " ".join(title.replace("_", " ").lower().split())
+
+class TransientError(Exception):
+    '''
+    Raised by ResolverTransport when a request still fails after every
+    retry
+    '''
+    pass
+
+class ResolverTransport:
+    '''
+    ResolverTransport(baseURL = "http://www.google.com", userAgent =
+                      AppURLopener.version, poolSize = 4, connectTimeout = 5,
+                      readTimeout = 15, retries = 3, backoff = 0.5,
+                      maxBackoff = 30)
+    - HTTP GETs against one server over a pool of persistent connections.
+    At most poolSize requests are in flight at once and idle connections
+    are kept open for the next request instead of reconnecting each time.
+    Responses are asked for gzipped and unzipped as they are read.
+    connectTimeout and readTimeout (seconds) bound the connect and every
+    socket read. Connection errors, timeouts and 429/5xx responses are
+    retried up to retries times, sleeping a random time up to
+    backoff * 2 ** attempt (capped at maxBackoff) in between; a kept-alive
+    connection the server has since dropped is retried at once. Point
+    baseURL at a local stub server to test without the network.
+    '''
+    retryStatuses = (429, 500, 502, 503, 504)
+    drainLimit = 65536
+    
+    def __init__(self, baseURL = "http://www.google.com",
+                 userAgent = AppURLopener.version, poolSize = 4,
+                 connectTimeout = 5, readTimeout = 15, retries = 3,
+                 backoff = 0.5, maxBackoff = 30):
+        parts = urlparse.urlsplit(baseURL)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.basePath = parts.path.rstrip("/")
+        self.userAgent = userAgent
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.idle = Queue.LifoQueue(poolSize)
+        self.slots = threading.BoundedSemaphore(poolSize)
+        self.connections = 0
+        self.requests = 0
+    
+    def _connect(self):
+        if self.https:
+            conn = httplib.HTTPSConnection(self.host, self.port,
+                                           timeout = self.connectTimeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout = self.connectTimeout)
+        conn.connect()
+        conn.sock.settimeout(self.readTimeout)
+        self.connections += 1
+        return conn
+    
+    def _release(self, conn, reusable):
+        if conn is not None:
+            if reusable:
+                try:
+                    self.idle.put_nowait(conn)
+                    conn = None
+                except Queue.Full:
+                    pass
+            if conn is not None:
+                conn.close()
+        self.slots.release()
+    
+    def backoffDelay(self, attempt):
+        '''
+        backoffDelay(self, attempt)
+        -returns the seconds to sleep before retry number attempt (from 0)
+        '''
+        return random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt))
+    
+    def request(self, path, headers = {}):
+        '''
+        request(self, path, headers = {})
+        -GETs baseURL + path and returns a TransportResponse, which must be
+        closed (or read to the end) to give its connection back. Raises
+        TransientError if every attempt fails
+        '''
+        allHeaders = {"User-Agent": self.userAgent,
+                      "Accept-Encoding": "gzip",
+                      "Connection": "keep-alive"}
+        allHeaders.update(headers)
+        attempt = 0
+        while True:
+            self.slots.acquire()
+            conn = None
+            reused = False
+            try:
+                try:
+                    conn = self.idle.get_nowait()
+                    reused = True
+                except Queue.Empty:
+                    conn = self._connect()
+                conn.request("GET", self.basePath + path, headers = allHeaders)
+                response = conn.getresponse()
+                self.requests += 1
+            except (socket.error, httplib.HTTPException), error:
+                self._release(conn, False)
+                if reused:
+                    continue
+                failure = error
+            else:
+                if response.status not in self.retryStatuses or attempt >= self.retries:
+                    return TransportResponse(self, conn, response)
+                response.read()
+                self._release(conn, not response.will_close)
+                failure = "HTTP " + str(response.status)
+            if attempt >= self.retries:
+                raise TransientError(path + ": " + str(failure))
+            time.sleep(self.backoffDelay(attempt))
+            attempt += 1
+    
+    def get(self, path, headers = {}):
+        '''
+        get(self, path, headers = {})
+        -returns (status, body) for baseURL + path
+        '''
+        response = self.request(path, headers)
+        try:
+            return response.status, response.read()
+        finally:
+            response.close()
+    
+    def close(self):
+        '''
+        close(self)
+        -closes every idle connection
+        '''
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+class TransportResponse:
+    '''
+    TransportResponse(transport, conn, response)
+    - A response from ResolverTransport.request. read(size) returns up to
+    size bytes of the unzipped body and '' at the end. close() gives the
+    connection back to the pool if the body was read to the end or what is
+    left of it is no more than the transport's drainLimit bytes, and closes
+    it otherwise.
+    '''
+    def __init__(self, transport, conn, response):
+        self.transport = transport
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.closed = False
+        self.bytesRead = 0
+        if (response.getheader("content-encoding") or "").lower() == "gzip":
+            self.unzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.unzip = None
+    
+    def read(self, size = -1):
+        '''
+        read(self, size = -1)
+        -returns the next chunk of the body, all of it if size is negative
+        '''
+        if self.closed:
+            return ""
+        while True:
+            try:
+                if size < 0:
+                    data = self.response.read()
+                else:
+                    data = self.response.read(size)
+            except (socket.error, httplib.HTTPException), error:
+                self.close()
+                raise TransientError("read failed: " + str(error))
+            self.bytesRead += len(data)
+            if not data:
+                rest = ""
+                if self.unzip is not None:
+                    rest = self.unzip.flush()
+                self.close()
+                return rest
+            if self.unzip is None:
+                return data
+            data = self.unzip.decompress(data)
+            if data:
+                return data
+    
+    def close(self):
+        '''
+        close(self)
+        -finishes with the response
+        '''
+        if not self.closed:
+            self.closed = True
+            response = self.response
+            if (not response.isclosed() and response.length is not None and
+                response.length <= self.transport.drainLimit):
+                try:
+                    response.read()
+                except (socket.error, httplib.HTTPException):
+                    pass
+            done = response.isclosed() and not response.will_close
+            self.transport._release(self.conn, done)
+
+class LookupResult:
+    '''
+    LookupResult(name, status, bytesRead)
+    - What SearchResolver.lookup found: status is "found" (name is set),
+    "nomatch" (the page had no wikipedia link) or "error" (the search
+    failed). bytesRead counts the raw bytes read off the wire.
+    '''
+    def __init__(self, name, status, bytesRead):
+        self.name = name
+        self.status = status
+        self.bytesRead = bytesRead
+    
+    def __repr__(self):
+        return "LookupResult(%r, %r, %r)" % (self.name, self.status, self.bytesRead)
+
+class SearchResolver:
+    '''
+    SearchResolver(transport = None, delay = 5, chunkSize = 4096)
+    - A resolver for parseTitle that does the google search for "title
+    anime site:wikipedia.org" over a ResolverTransport and takes the name
+    from the first wikipedia link. The results page is read chunkSize bytes
+    at a time and reading stops as soon as a link is found. delay is the
+    pause in seconds before each query, as parseTitle always did.
+    '''
+    def __init__(self, transport = None, delay = 5, chunkSize = 4096):
+        if transport is None:
+            transport = ResolverTransport()
+        self.transport = transport
+        self.delay = delay
+        self.chunkSize = chunkSize
+    
+    def __call__(self, title):
+        return self.resolve(title)
+    
+    def searchPath(self, title):
+        '''
+        searchPath(self, title)
+        -returns the search path to request for title
+        '''
+        return "/search?q=" + urllib.quote_plus(title + " anime site:wikipedia.org")
+    
+    def lookup(self, title):
+        '''
+        lookup(self, title)
+        -returns a LookupResult for title. Never raises for a failed search
+        '''
+        if self.delay:
+            time.sleep(self.delay)
+        try:
+            response = self.transport.request(self.searchPath(title))
+        except TransientError:
+            return LookupResult(None, "error", 0)
+        try:
+            if response.status != 200:
+                return LookupResult(None, "error", response.bytesRead)
+            extractor = WikiLinkExtractor()
+            while True:
+                chunk = response.read(self.chunkSize)
+                if not chunk:
+                    return LookupResult(None, "nomatch", response.bytesRead)
+                name = extractor.feed(chunk)
+                if name is not None:
+                    return LookupResult(name, "found", response.bytesRead)
+        except TransientError:
+            return LookupResult(None, "error", response.bytesRead)
+        finally:
+            response.close()
+    
+    def resolve(self, title):
+        '''
+        resolve(self, title)
+        -returns the standardized name of title, or None if the search has
+        no wikipedia link. Raises TransientError if the search fails, so a
+        failure is never mistaken for an unknown title
+        '''
+        result = self.lookup(title)
+        if result.status == "error":
+            raise TransientError(title + ": search failed")
+        return result.name
+
+class WikiLinkExtractor:
+    '''
+    WikiLinkExtractor()
+    - Finds the first english wikipedia article link in a page fed to it
+    in chunks. Between chunks only the tail that could hold the start of a
+    split link is kept. The article name runs until a character that can't
+    be part of the url and is then url-decoded, so Denn%C5%8D_Coil becomes
+    the utf-8 name instead of being cut at the %. Links into other
+    namespaces (File:, Special: ...) are skipped.
+    '''
+    prefixes = ["http://en.wikipedia.org/wiki/", "https://en.wikipedia.org/wiki/"]
+    terminators = "&\"'<> \t\r\n#?"
+    skipNamespaces = ("special:", "file:", "image:", "help:", "wikipedia:",
+                      "category:", "talk:", "template:", "portal:")
+    maxName = 200
+    
+    def __init__(self):
+        self.buffer = ""
+    
+    def feed(self, chunk):
+        '''
+        feed(self, chunk)
+        -adds the next chunk of the page, and returns the article name once
+        a complete link has been seen, else None
+        '''
+        data = self.buffer + chunk
+        position = 0
+        while True:
+            starts = [(data.find(prefix, position), prefix) for prefix in self.prefixes]
+            starts = [(i, prefix) for (i, prefix) in starts if i != -1]
+            if not starts:
+                keep = max(len(prefix) for prefix in self.prefixes)
+                self.buffer = data[max(position, len(data) - keep):]
+                return None
+            start, prefix = min(starts)
+            nameStart = start + len(prefix)
+            end = nameStart
+            while end < len(data) and data[end] not in self.terminators:
+                end += 1
+            if end == len(data) and end - nameStart <= self.maxName:
+                self.buffer = data[start:]
+                return None
+            name = urllib.unquote(data[nameStart:end])
+            position = nameStart
+            if 0 < len(name) <= self.maxName and \
+               not name.lower().startswith(self.skipNamespaces):
+                return name
+    
+    def close(self):
+        '''
+        close(self)
+        -call at the end of the page; returns a link cut off by the end of
+        the page, or None
+        '''
+        return self.feed("\n")
+
+def extractWikiName(source):
+    '''
+    extractWikiName(source)
+    -returns the article name from the first english wikipedia link in a
+    search results page, or None
+    '''
+    extractor = WikiLinkExtractor()
+    name = extractor.feed(source)
+    if name is None:
+        name = extractor.close()
+    return name
+
+class TokenBucket:
+    '''
+    TokenBucket(rate, burst = 1)
+    - A thread safe rate limiter. Tokens come in at rate per second up to a
+    maximum of burst, and acquire() takes one, sleeping until one is there.
+    Over any stretch of time no more than burst + rate * seconds tokens are
+    handed out.
+    '''
+    def __init__(self, rate, burst = 1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        '''
+        acquire(self)
+        -waits for and takes one token
+        '''
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+class BatchResolver:
+    '''
+    BatchResolver(resolver = None, concurrency = 4, rate = 0.2, burst = 1,
+                  commitEvery = 50)
+    - Resolves a batch of titles with concurrency worker threads, while a
+    TokenBucket keeps the queries to rate per second (with bursts of up to
+    burst). parseTitle sleeps and then waits on each query in turn; here the
+    waiting for the next token overlaps with the queries in flight, so the
+    same budget gets through a batch several times faster. A title asked
+    for again while its lookup is still running waits for that lookup
+    instead of querying twice. New names are written to the names database
+    every commitEvery results instead of after each one. resolver defaults
+    to a SearchResolver sharing a pool of concurrency connections.
+    '''
+    def __init__(self, resolver = None, concurrency = 4, rate = 0.2, burst = 1,
+                 commitEvery = 50):
+        if resolver is None:
+            resolver = SearchResolver(ResolverTransport(poolSize = concurrency),
+                                      delay = 0)
+        self.resolver = resolver
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.commitEvery = commitEvery
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.failures = {}
+    
+    def lookup(self, title):
+        '''
+        lookup(self, title)
+        -returns the resolver's name for title (or None), sharing the answer
+        with any other thread asking for the same title at the same time.
+        Raises the resolver's error (usually a TransientError) if the
+        lookup failed
+        '''
+        self.lock.acquire()
+        pending = self.inflight.get(title)
+        owner = pending is None
+        if owner:
+            pending = [threading.Event(), None, None]
+            self.inflight[title] = pending
+        self.lock.release()
+        if not owner:
+            pending[0].wait()
+        else:
+            try:
+                self.bucket.acquire()
+                pending[1] = self.resolver(title)
+            except Exception, error:
+                # waiters get the same error instead of waiting forever
+                pending[2] = error
+            self.lock.acquire()
+            del self.inflight[title]
+            self.lock.release()
+            pending[0].set()
+        if pending[2] is not None:
+            raise pending[2]
+        return pending[1]
+    
+    def resolveAll(self, titles, dbFile, database):
+        '''
+        resolveAll(self, titles, dbFile, database)
+        -resolves every title not already in database and returns a dict
+        of title to standardized name for all of them, with "Unknown" for
+        titles the resolver doesn't know. Titles whose lookup failed, with
+        a TransientError or any other exception, are left out and listed in
+        failures
+        '''
+        result = {}
+        todo = []
+        for title in titles:
+            title = title.lower()
+            if title in database:
+                result[title] = database[title]
+            elif title not in result:
+                result[title] = None
+                todo.append(title)
+        work = Queue.Queue()
+        for title in todo:
+            work.put(title)
+        done = Queue.Queue()
+        
+        def worker():
+            while True:
+                try:
+                    title = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    done.put((title, self.lookup(title), None))
+                except Exception, error:
+                    # anything, so resolveAll still gets an answer per title
+                    done.put((title, None, error))
+        
+        threads = [threading.Thread(target = worker)
+                   for i in xrange(min(self.concurrency, len(todo)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        uncommitted = 0
+        for i in xrange(len(todo)):
+            title, seriesName, error = done.get()
+            if error is not None:
+                self.failures[title] = error
+                del result[title]
+                continue
+            if seriesName is None:
+                result[title] = "Unknown"
+                continue
+            result[title] = seriesName
+            database[title] = seriesName
+            uncommitted += 1
+            if uncommitted >= self.commitEvery:
+                saveDB(database, dbFile)
+                uncommitted = 0
+        if uncommitted:
+            saveDB(database, dbFile)
+        for thread in threads:
+            thread.join()
+        return result
+    
+    def resolveFile(self, txtfile, dbFile, database):
+        '''
+        resolveFile(self, txtfile, dbFile, database)
+        -resolves all the titles in a parseData text file up front, so
+        parseData afterwards only hits the names database
+        '''
+        titles = []
+        data = open(txtfile, 'r')
+        for i, line in enumerate(data):
+            if i % 10 != 0:
+                titles.append(line.rstrip("\r\n"))
+        data.close()
+        return self.resolveAll(titles, dbFile, database)
+
+_defaultResolver = []
+
+def defaultResolver():
+    '''
+    defaultResolver()
+    -returns the SearchResolver parseTitle uses when it isn't given one,
+    so every lookup shares one connection pool
+    '''
+    if not _defaultResolver:
+        _defaultResolver.append(SearchResolver())
+    return _defaultResolver[0]
+
+def printScale(ranking):
+    '''
+    printScale(ranking)
+    -prints (rank, show, value) tuples as a scale, in one write
+    '''
+    lines = []
+    for rank, show, value in ranking:
+        lines.append("Rank:" + str(rank) + " | Title: " + show + " - " +
+                     str(value) + "\n")
+    sys.stdout.write("".join(lines))
+
+def convertToInputList(string):
+    '''
+    convertToInputList(string):
+    -convert multiline sting of shows into a list
+    '''
+    result = []
+    show = ''
+    for i in string:
+        if i != '\n':
+            show += i
         else:
             result.append(show)
             show = ''
     return result
 
 
+aliasMagic = "NFMALS01"
+
+def _aliasBytes(string):
+    # the store holds utf-8; returns the bytes and whether it was unicode
+    if isinstance(string, unicode):
+        return string.encode("utf-8"), 1
+    return string, 0
+
+def writeAliasStore(database, aliasFile):
+    '''
+    writeAliasStore(database, aliasFile)
+    -writes a name conversion dictionary (or an AliasStore) as an
+    AliasStore file. Every distinct standardized name is stored once; the
+    layout is the magic, five section offsets, the sorted titles
+    (packStrings), a flag byte per title, the uint32 name id of each title,
+    the sorted names and a flag byte per name. A flag of 1 means the string
+    was unicode, so converting back gives the same dictionary. A title held
+    both as unicode and as its utf-8 str would be two equal keys in the
+    sorted titles, so only the str one is kept
+    '''
+    names = {}
+    for name in database.itervalues():
+        names[_aliasBytes(name)] = None
+    nameList = sorted(names)
+    for i, name in enumerate(nameList):
+        names[name] = i
+    byBytes = {}
+    for title, name in database.iteritems():
+        key, flag = _aliasBytes(title)
+        if key not in byBytes or flag == 0:
+            byBytes[key] = (flag, names[_aliasBytes(name)])
+    titles = sorted(((key, flag), i) for (key, (flag, i)) in byBytes.iteritems())
+    sections = [packStrings([title for ((title, flag), i) in titles]),
+                "".join([chr(flag) for ((title, flag), i) in titles]),
+                struct.pack("<%dI" % len(titles), *[i for (title, i) in titles]),
+                packStrings([name for (name, flag) in nameList]),
+                "".join([chr(flag) for (name, flag) in nameList])]
+    writeSections(aliasFile, aliasMagic, sections)
+
+class AliasStore:
+    '''
+    AliasStore(aliasFile)
+    - A name conversion dictionary opened from a file written by
+    writeAliasStore. The file is mmap'd read only and nothing is decoded up
+    front, so opening it costs the same however many titles it holds; a
+    lookup is a binary search of the sorted titles and reads the name by
+    its id. Each name is only built once and then shared by every title
+    that converts to it. It acts like the dict loadDB used to return:
+    titles added with store[title] = name are kept in memory on top of the
+    file until saveDB writes them all out
+    '''
+    def __init__(self, aliasFile):
+        data = open(aliasFile, 'rb')
+        self.buffer = mmap.mmap(data.fileno(), 0, access = mmap.ACCESS_READ)
+        data.close()
+        if self.buffer[:len(aliasMagic)] != aliasMagic:
+            raise ValueError(aliasFile + " is not an alias store")
+        (titles, self.titleFlags, self.ids, names,
+         self.nameFlags) = struct.unpack_from("<5Q", self.buffer, len(aliasMagic))
+        self.titles = MappedStrings(self.buffer, titles)
+        self.names = MappedStrings(self.buffer, names)
+        self.nameCache = {}
+        self.added = {}
+    
+    def close(self):
+        '''
+        close(self)
+        -unmaps the file
+        '''
+        self.buffer.close()
+    
+    def _title(self, i):
+        title = self.titles[i]
+        if self.buffer[self.titleFlags + i] == "\1":
+            return title.decode("utf-8")
+        return title
+    
+    def _name(self, i):
+        i = struct.unpack_from("<I", self.buffer, self.ids + 4 * i)[0]
+        name = self.nameCache.get(i)
+        if name is None:
+            name = self.names[i]
+            if self.buffer[self.nameFlags + i] == "\1":
+                name = name.decode("utf-8")
+            self.nameCache[i] = name
+        return name
+    
+    def __len__(self):
+        return len(self.titles) + len([key for key in self.added
+                                       if self.titles.find(key) == -1])
+    
+    def __contains__(self, title):
+        key = _aliasBytes(title)[0]
+        return key in self.added or self.titles.find(key) != -1
+    
+    def __getitem__(self, title):
+        key = _aliasBytes(title)[0]
+        if key in self.added:
+            return self.added[key][1]
+        i = self.titles.find(key)
+        if i == -1:
+            raise KeyError(title)
+        return self._name(i)
+    
+    def __setitem__(self, title, name):
+        # keyed by the utf-8 bytes, as the file is, so a unicode title and
+        # its utf-8 str are the same entry
+        self.added[_aliasBytes(title)[0]] = (title, name)
+    
+    def copy(self):
+        '''
+        copy(self)
+        -returns a store over the same mapped file with its own copy of the
+        added titles, like dict.copy. Closing either closes the file for both
+        '''
+        clone = copy.copy(self)
+        clone.added = dict(self.added)
+        return clone
+    
+    def get(self, title, default = None):
+        '''
+        get(self, title, default = None)
+        -returns the name title converts to, or default
+        '''
+        try:
+            return self[title]
+        except KeyError:
+            return default
+    
+    def iteritems(self):
+        '''
+        iteritems(self)
+        -yields every (title, name), the file's in sorted order and then
+        the added ones
+        '''
+        for i in xrange(len(self.titles)):
+            if self.titles[i] not in self.added:
+                yield self._title(i), self._name(i)
+        for item in self.added.itervalues():
+            yield item
+    
+    def __iter__(self):
+        for title, name in self.iteritems():
+            yield title
+    
+    def itervalues(self):
+        for title, name in self.iteritems():
+            yield name
+    
+    def keys(self):
+        return list(self)
+    
+    def values(self):
+        return list(self.itervalues())
+    
+    def items(self):
+        return list(self.iteritems())
+
+def pickleToAliasStore(dbFile, aliasFile):
+    '''
+    pickleToAliasStore(dbFile, aliasFile)
+    -converts a pickled name conversion dictionary to an AliasStore file
+    '''
+    pkl_file = open(dbFile, 'rb')
+    database = pickle.load(pkl_file)
+    pkl_file.close()
+    writeAliasStore(database, aliasFile)
+
+def aliasStoreToPickle(aliasFile, dbFile):
+    '''
+    aliasStoreToPickle(aliasFile, dbFile)
+    -converts an AliasStore file back to a pickled dictionary, as saveDB
+    would have written it
+    '''
+    store = AliasStore(aliasFile)
+    database = dict(store.iteritems())
+    store.close()
+    output = open(dbFile, 'wb')
+    pickle.dump(database, output)
+    output.close()
+
+def saveDB(database, dbFile):
+    '''
+    saveDB(database, dbFile)
+    writes the name conversion dictionary to dbFile. An AliasStore is
+    written back as one, so the file keeps its format
+    '''
+    if isinstance(database, AliasStore):
+        writeAliasStore(database, dbFile)
+        return
+    output = open(dbFile, 'wb')
+    pickle.dump(database, output)
+    output.close()
+
 def loadDB(dbFile):
     '''
     loadDB(dbFile)
-    takes in a pickled dictionary, and returns the dictionary
+    takes in a pickled dictionary, and returns the dictionary. If dbFile is
+    an alias store it is opened as an AliasStore instead
     '''
     print "loading database"
     pkl_file = open(dbFile, 'rb')
+    magic = pkl_file.read(len(aliasMagic))
+    if magic == aliasMagic:
+        pkl_file.close()
+        return AliasStore(dbFile)
+    pkl_file.seek(0)
     database = pickle.load(pkl_file)
     pkl_file.close()
     return database
 
-Detector = NewFagMeter("data.txt", "anime.pkl")
-Detector.naiveLearn()
-print "classification error: ", str(Detector.binaryISE())+ "%"
-print "mean :", Detector.getMeanScore()
-print "median :", Detector.getMedianScore()
-print "most oldfag show:", Detector.ithLargest(1)
-print "most newfag show:", Detector.ithSmallest(1)
-print "most popular show:", Detector.ithPopular(1)
-print "most hipster show:", Detector.ithHipster(1)
-print "number of entries:", Detector.userBaseSize()
-print "number of shows:", Detector.numberShows()
-print "popularity scale: "
-Detector.printPopularityScale()
-print "power level scale: "
-Detector.printPowerLevelScale()
-
-inpt = '''
+if __name__ == "__main__":
+    # the demo only runs as a script, so the library can be loaded as a
+    # module (see ScoringPool)
+    Detector = NewFagMeter("data.txt", "anime.pkl")
+    Detector.naiveLearn()
+    print "classification error: ", str(Detector.binaryISE())+ "%"
+    print "mean :", Detector.getMeanScore()
+    print "median :", Detector.getMedianScore()
+    print "most oldfag show:", Detector.ithLargest(1)
+    print "most newfag show:", Detector.ithSmallest(1)
+    print "most popular show:", Detector.ithPopular(1)
+    print "most hipster show:", Detector.ithHipster(1)
+    print "number of entries:", Detector.userBaseSize()
+    print "number of shows:", Detector.numberShows()
+    print "popularity scale: "
+    Detector.printPopularityScale()
+    print "power level scale: "
+    Detector.printPowerLevelScale()
+    
+    inpt = '''
 Haibane Renmei
 Yojouhan Shinwa Taikei
 Fuujin Monogatari
@@ -557,6 +5481,5 @@ Nekojiru-sou
 5 centimeters per second
 Hotarubi no Mori e
 '''
-print Detector.linearClassifyPop(convertToInputList(inpt))
-a = raw_input()
-
+    print Detector.linearClassifyPop(convertToInputList(inpt))
+    a = raw_input()
@@ -0,0 +1,301 @@
+'''
+regression.py - compares every generation of the meter (newfag.py,
+newfag1.2.py ... newfag1.5.py) on the same generated data, so a change to
+the engine can be measured against the old ones for speed and for drift in
+its results.
+
+    python regression.py [--users 200,1000] [--seed 0] [--repeat 3]
+                         [--json report.json] [version.py ...]
+
+Each version's NewFagMeter is loaded by running its source up to the
+module level script (the "Detector = NewFagMeter(" line), or all of it
+when the script is under an if __name__ == "__main__" guard, so nothing
+is printed or trained on import. The datasets are generated from --seed with
+titles taken from anime.pkl, so no version ever goes to the network, and
+they are written to a temporary directory together with a copy of
+anime.pkl, so the real names file is never touched.
+
+Every (version, dataset) run happens in a fresh child process, so the peak
+memory of one doesn't leak into the next. Timings are the best of --repeat
+runs; the results of every repeat have to agree or the run is marked as not
+deterministic. The first version listed is the baseline the others are
+compared to.
+
+Report (one table per dataset):
+    construct, learn, ise
+        - seconds to build the NewFagMeter (parsing included), for
+        naiveLearn, and for binaryISE
+    peak MB
+        - the child's peak resident memory
+    binaryISE, mean, median
+        - as the meter reports them
+    drift
+        - how many shows differ from the baseline's catalog, the largest
+        difference in weight of a shared show, and whether the full power
+        level ranking is the same
+and every version's answer to each ithLargest, ithSmallest, ithPopular
+and ithHipster probe the versions disagree on; probes they all answer the
+same way are only counted.
+'''
+
+import sys, os, time, json, random, pickle, shutil, tempfile, subprocess, resource
+import StringIO
+
+defaultVersions = ["newfag.py", "newfag1.2.py", "newfag1.3.py", "newfag1.4.py",
+                   "newfag1.5.py"]
+
+probes = [("ithLargest", 1), ("ithSmallest", 0), ("ithSmallest", 1),
+          ("ithPopular", 1), ("ithHipster", 0), ("ithHipster", 1)]
+
+def loadVersion(filename):
+    '''
+    loadVersion(filename)
+    -runs a version's source up to its module level script and returns its
+    namespace, which has its NewFagMeter, parseData and so on. A script
+    under an if __name__ == "__main__" guard is left in, as it won't run
+    '''
+    source = open(filename).read()
+    cut = source.find("\nDetector = NewFagMeter(")
+    if cut == -1:
+        if "\nif __name__ == \"__main__\":" not in source:
+            raise ValueError(filename + " has no module level NewFagMeter script")
+        cut = len(source)
+    namespace = {"__name__": "__regression__", "__file__": filename}
+    exec compile(source[:cut], filename, "exec") in namespace
+    return namespace
+
+def generateData(txtFile, database, users, seed):
+    '''
+    generateData(txtFile, database, users, seed)
+    -writes users records in the data.txt format to txtFile. Titles are
+    drawn from the lowercase keys of database, a few of them far more often
+    than the rest, and each series has a hidden age so the show counts it
+    is listed with (and so its weight) actually depend on it
+    '''
+    rand = random.Random(seed)
+    # parseTitle lowercases before looking a title up, so only lowercase
+    # keys are guaranteed to be found without a search
+    titles = sorted(title for title in database
+                    if title and title == title.lower() and title == title.strip())
+    popularity = [1.0 / (rank + 1) for rank in xrange(len(titles))]
+    rand.shuffle(popularity)
+    age = dict((database[title], rand.random()) for title in titles)
+    output = open(txtFile, 'w')
+    for user in xrange(users):
+        listed = []
+        while len(listed) < 9:
+            title = _weightedChoice(rand, titles, popularity)
+            if title not in listed:
+                listed.append(title)
+        oldness = sum(age[database[title]] for title in listed) / 9
+        shows = int(rand.lognormvariate(3 + 2 * oldness, 0.5))
+        output.write(str(shows) + "\n")
+        for title in listed:
+            output.write(title + "\n")
+    output.close()
+
+def _weightedChoice(rand, items, weights):
+    point = rand.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        point -= weight
+        if point < 0:
+            return item
+    return items[-1]
+
+def peakMemory():
+    '''
+    peakMemory()
+    -returns the peak resident memory of this process in MB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1048576.0
+    return peak / 1024.0
+
+def measure(versionFile, txtFile, dbFile):
+    '''
+    measure(versionFile, txtFile, dbFile)
+    -builds, trains and evaluates one version on one dataset in this
+    process, and returns what it found as a dict
+    '''
+    namespace = loadVersion(versionFile)
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        start = time.time()
+        meter = namespace["NewFagMeter"](txtFile, dbFile)
+        built = time.time()
+        meter.naiveLearn()
+        learnt = time.time()
+        ise = meter.binaryISE()
+        evaluated = time.time()
+        result = {"construct": built - start,
+                  "learn": learnt - built,
+                  "ise": evaluated - learnt,
+                  "peakMB": peakMemory(),
+                  "users": meter.userBaseSize(),
+                  "shows": meter.numberShows(),
+                  "binaryISE": ise,
+                  "mean": meter.getMeanScore(),
+                  "median": meter.getMedianScore(),
+                  "weights": dict(zip(meter.seriesList, meter.seriesWeights)),
+                  "powerRanking": [show for (weight, show) in
+                                   sorted(zip(meter.seriesWeights, meter.seriesList),
+                                          reverse = True)],
+                  "probes": {}}
+        for method, i in probes:
+            try:
+                answer = list(getattr(meter, method)(i))
+            except Exception, error:
+                answer = "error: " + repr(error)
+            result["probes"]["%s(%d)" % (method, i)] = answer
+    finally:
+        sys.stdout = stdout
+    return result
+
+def runChild(versionFile, txtFile, dbFile):
+    '''
+    runChild(versionFile, txtFile, dbFile)
+    -runs measure in a fresh python process and returns its result
+    '''
+    command = [sys.executable, os.path.abspath(__file__), "--child",
+               versionFile, txtFile, dbFile]
+    child = subprocess.Popen(command, stdout = subprocess.PIPE,
+                             cwd = os.path.dirname(dbFile))
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        raise RuntimeError(versionFile + " failed on " + txtFile)
+    return json.loads(output)
+
+def _sameResults(a, b):
+    timings = ("construct", "learn", "ise", "peakMB")
+    return (dict((k, v) for (k, v) in a.iteritems() if k not in timings) ==
+            dict((k, v) for (k, v) in b.iteritems() if k not in timings))
+
+def drift(baseline, result):
+    '''
+    drift(baseline, result)
+    -returns how result differs from baseline: the shows only one of them
+    has, the largest weight difference of a shared show, and whether the
+    power level rankings are identical
+    '''
+    shared = set(baseline["weights"]) & set(result["weights"])
+    changed = len(set(baseline["weights"]) ^ set(result["weights"]))
+    largest = max([abs(baseline["weights"][show] - result["weights"][show])
+                   for show in shared] or [0.0])
+    return {"catalogChanges": changed,
+            "largestWeightChange": largest,
+            "sameRanking": baseline["powerRanking"] == result["powerRanking"]}
+
+def runAll(versions, userCounts, seed, repeat, root):
+    '''
+    runAll(versions, userCounts, seed, repeat, root)
+    -generates a dataset for every user count and runs every version on
+    it repeat times. Returns the report as a dict
+    '''
+    workDir = tempfile.mkdtemp(prefix = "newfag-regression-")
+    try:
+        dbFile = os.path.join(workDir, "anime.pkl")
+        shutil.copy(os.path.join(root, "anime.pkl"), dbFile)
+        pkl_file = open(dbFile, 'rb')
+        database = pickle.load(pkl_file)
+        pkl_file.close()
+        report = {"seed": seed, "repeat": repeat, "python": sys.version.split()[0],
+                  "versions": versions, "datasets": []}
+        for n, users in enumerate(userCounts):
+            txtFile = os.path.join(workDir, "data%d.txt" % users)
+            generateData(txtFile, database, users, seed + n)
+            dataset = {"users": users, "seed": seed + n, "results": {}}
+            for version in versions:
+                runs = [runChild(os.path.join(root, version), txtFile, dbFile)
+                        for i in xrange(repeat)]
+                result = runs[0]
+                for timing in ("construct", "learn", "ise", "peakMB"):
+                    result[timing] = min(run[timing] for run in runs)
+                result["deterministic"] = all(_sameResults(runs[0], run) for run in runs)
+                dataset["results"][version] = result
+            baseline = dataset["results"][versions[0]]
+            for version in versions:
+                dataset["results"][version]["drift"] = drift(baseline,
+                                                             dataset["results"][version])
+            report["datasets"].append(dataset)
+        return report
+    finally:
+        shutil.rmtree(workDir)
+
+def printReport(report, out = sys.stdout):
+    '''
+    printReport(report, out = sys.stdout)
+    -writes the report as text tables
+    '''
+    versions = report["versions"]
+    out.write("seed %d, best of %d, python %s, baseline %s\n" %
+              (report["seed"], report["repeat"], report["python"], versions[0]))
+    for dataset in report["datasets"]:
+        out.write("\n%d generated users (seed %d)\n" % (dataset["users"], dataset["seed"]))
+        out.write("%-14s %6s %10s %8s %8s %8s %9s %8s %7s %8s %9s %8s\n" %
+                  ("version", "shows", "construct", "learn", "ise", "peak MB",
+                   "binaryISE", "mean", "median", "catalog", "max dW", "ranking"))
+        for version in versions:
+            result = dataset["results"][version]
+            change = result["drift"]
+            ranking = "same" if change["sameRanking"] else "differs"
+            if not result["deterministic"]:
+                ranking += "*"
+            out.write("%-14s %6d %10.3f %8.3f %8.3f %8.1f %9.3f %8.2f %7d %8d %9.3g %8s\n" %
+                      (version, result["shows"], result["construct"], result["learn"],
+                       result["ise"], result["peakMB"], result["binaryISE"],
+                       result["mean"], result["median"], change["catalogChanges"],
+                       change["largestWeightChange"], ranking))
+        agreed = 0
+        for method, i in probes:
+            probe = "%s(%d)" % (method, i)
+            answers = [dataset["results"][version]["probes"][probe] for version in versions]
+            if all(answer == answers[0] for answer in answers):
+                agreed += 1
+                continue
+            out.write("  %-15s" % probe)
+            out.write(" | ".join(["%s: %s" % (version, _formatProbe(answer))
+                                  for version, answer in zip(versions, answers)]))
+            out.write("\n")
+        if agreed:
+            out.write("  %d of %d probes agree across versions\n" % (agreed, len(probes)))
+    if not all(result["deterministic"] for dataset in report["datasets"]
+               for result in dataset["results"].itervalues()):
+        out.write("\n* results changed between repeats\n")
+
+def _formatProbe(answer):
+    if isinstance(answer, list):
+        return "%s %.4g" % (answer[0], answer[1])
+    return answer
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    if arguments[:1] == ["--child"]:
+        result = measure(*arguments[1:4])
+        sys.stdout.write(json.dumps(result))
+        sys.exit(0)
+    userCounts = [200, 1000]
+    seed = 0
+    repeat = 3
+    jsonFile = None
+    versions = []
+    while arguments:
+        argument = arguments.pop(0)
+        if argument == "--users":
+            userCounts = [int(users) for users in arguments.pop(0).split(",")]
+        elif argument == "--seed":
+            seed = int(arguments.pop(0))
+        elif argument == "--repeat":
+            repeat = int(arguments.pop(0))
+        elif argument == "--json":
+            jsonFile = arguments.pop(0)
+        else:
+            versions.append(argument)
+    root = os.path.dirname(os.path.abspath(__file__))
+    report = runAll(versions or defaultVersions, userCounts, seed, repeat, root)
+    printReport(report)
+    if jsonFile is not None:
+        output = open(jsonFile, 'w')
+        json.dump(report, output, indent = 1, sort_keys = True)
+        output.close()